@@ -5,18 +5,32 @@ and latency to a collection of far-end hosts.
 """
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.executors.pool import ThreadPoolExecutor, ProcessPoolExecutor
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.executors.pool import ThreadPoolExecutor
 from concurrent import futures
+import collections
 import flask
+import functools
+import gzip
+import hashlib
 import humanfriendly
+import io
 import json
 import logging
+import math
+import multiprocessing
 import os
+import Queue
+import signal
+import socket
+import threading
 import time
+import zlib
 
 from llama import config
 from llama import metrics
 from llama import ping
+from llama import udp
 from llama import util
 from version import __version__
 
@@ -25,68 +39,713 @@ class Error(Exception):
     """Top level error."""
 
 
+def stagger_offset(host, window, seed=''):
+    """Returns a stable offset for a host, evenly distributed over a window.
+
+    Args:
+        host: (str) target host
+        window: (float) seconds the offset falls within
+        seed: (str) mixed into the hash so collectors can differ
+
+    Returns:
+        (float) seconds in [0, window)
+    """
+    digest = zlib.crc32('%s/%s' % (seed, host)) & 0xffffffff
+    return window * digest / float(1 << 32)
+
+
+def cycle_timing(interval, stagger=0, deadline=None):
+    """Returns the stagger window and per-host deadline of collections.
+
+    Each host's deadline counts from its offset into the stagger window, so
+    the two are fit into the interval together, and every host's results
+    are due before the next collection starts.
+
+    Args:
+        interval: (float) seconds between collections
+        stagger: (float) fraction of the interval to stagger hosts across
+        deadline: (float) seconds each host has to return results; None or
+                  0 for what the stagger window leaves of the interval, but
+                  at least half of it
+
+    Returns:
+        (tuple) of (window, deadline) in seconds
+    """
+    window = interval * stagger
+    if not deadline:
+        deadline = max(interval - window, interval / 2.0)
+    fitted = max(min(window, interval - deadline), 0.0)
+    if fitted < window:
+        logging.warning('Staggering targets across %.1fs instead of %.1fs '
+                        'so their %.1fs deadlines fit the %ss interval',
+                        fitted, window, deadline, interval)
+    return fitted, deadline
+
+
+def shard_of(host, shards):
+    """Returns which of ``shards`` worker processes probes a host.
+
+    Args:
+        host: (str) target host
+        shards: (int) number of shards
+
+    Returns:
+        (int) in [0, shards)
+    """
+    return (zlib.crc32(host) & 0xffffffff) % shards
+
+
+# Stands in for a config.CollectorConfig with a shard's hosts, untagged
+ShardTargets = collections.namedtuple('ShardTargets', ['targets'])
+
+
+class Cycles(object):
+    """Accounting of collection cycles.
+
+    Shows when a collector can't keep up with its interval: cycles which
+    overran it, and scheduled cycles which were missed or skipped because the
+    previous one was still running.
+    """
+
+    def __init__(self, interval=None):
+        """Constructor.
+
+        Args:
+            interval: (float) seconds between scheduled cycles, if any
+        """
+        self.interval = interval
+        self.count = 0
+        self.running = False
+        self.start = None
+        self.duration = None
+        self.max_duration = 0.0
+        self.targets = 0
+        self.targets_done = 0
+        self.targets_stale = 0
+        self.overruns = 0
+        self.missed = 0
+        self.overlapped = 0
+
+    def begin(self, targets):
+        """Mark the start of a cycle probing ``targets`` hosts."""
+        self.running = True
+        self.start = time.time()
+        self.targets = targets
+        self.targets_done = 0
+        self.targets_stale = 0
+
+    def end(self):
+        """Mark the end of the running cycle."""
+        self.running = False
+        self.count += 1
+        self.duration = time.time() - self.start
+        self.max_duration = max(self.max_duration, self.duration)
+        if self.interval and self.duration > self.interval:
+            self.overruns += 1
+            logging.warning('Collection took %.1fs, longer than the %ss '
+                            'interval', self.duration, self.interval)
+
+    @property
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'running': self.running,
+            'start': self.start,
+            'duration': self.duration,
+            'max_duration': self.max_duration,
+            'interval': self.interval,
+            'targets': self.targets,
+            'targets_done': self.targets_done,
+            'targets_stale': self.targets_stale,
+            'overruns': self.overruns,
+            'missed': self.missed,
+            'overlapped': self.overlapped,
+        }
+
+
 class Collection(object):
     """An abstraction for measuring latency to a group of targets."""
 
-    def __init__(self, config, use_udp=False):
+    # Groups of hosts staggered across the window by batched methods
+    STAGGER_SLOTS = 10
+
+    def __init__(self, config, use_udp=False, sequenced=False, polled=False,
+                 timestamps=False, pps=0, src_ports=None, workers=50,
+                 executor=None, interval=None, seed=None, history=0,
+                 processes=0):
         """Constructor.
 
         Args:
             config: (config.CollectorConfig) of targets
             udp: (bool) Use UDP datagrams for probes (requires Reflectors)
+            sequenced: (bool) Send UDP probes over one socket per target
+            polled: (bool) Send UDP probes for all targets from one thread
+            timestamps: (bool) Use kernel receive timestamps for UDP RTT
+            pps: (float) Limit on UDP probes per second across all targets,
+                 0 for no limit
+            src_ports: (list) of UDP source ports to sweep every target
+                       from, keeping stats per flow (requires polled)
+            workers: (int) Number of targets probed at once, unless polled
+            executor: (futures.Executor) with ``workers`` threads, kept
+                      between collections; one is created if None
+            interval: (float) Seconds between collections, to count overruns
+            seed: (str) Varies staggered offsets between collectors,
+                  defaults to the hostname
+            history: (int) Number of results kept for each target
+            processes: (int) Number of worker processes to shard targets
+                       across, each with its own probes; 0 or 1 probes
+                       from this process
+
+        Raises:
+            Error: if src_ports are given without polled UDP probes, or
+                   with more than one process
         """
+        if src_ports and not (use_udp and polled):
+            raise Error('Source port sweeps require polled UDP probes')
+        if src_ports and processes > 1:
+            # Every shard would bind the same ports
+            raise Error('Source port sweeps can\'t be sharded across '
+                        'processes')
+        self.workers = workers
+        self.executor = executor
+        self.cycles = Cycles(interval)
+        self.seed = socket.gethostname() if seed is None else seed
+        # Started before any sockets or threads of ours exist to be forked
+        self.shards = []
+        if processes > 1:
+            options = {
+                'use_udp': use_udp,
+                'sequenced': sequenced,
+                'polled': polled,
+                'timestamps': timestamps,
+                'pps': pps / float(processes),
+                'src_ports': src_ports,
+                'workers': int(math.ceil(workers / float(processes))),
+                'seed': self.seed,
+            }
+            self.shards = [Shard(x, options) for x in xrange(processes)]
+            for shard in self.shards:
+                shard.start()
         self.method = ping.hping3
-        if use_udp:
-            self.method = ping.send_udp
-        self.metrics = {}
+        # Batched methods take every target at once and return a list
+        self.batched = False
+        # Only UDP probes can be paced; hping3 sends at its own rate
+        self.paced = use_udp
+        self.pacer = util.TokenBucket(pps) if use_udp and pps else None
+        # Sequenced senders (and their sockets) are kept between collections
+        self.senders = {}
+        self.prober = None
+        # {(dst_ip, tos, src_port): udp.UdpStats} from the last collection
+        self.flows = {}
+        # {dst_ip: message} for targets which couldn't be resolved, kept
+        # apart from loss so a DNS problem isn't reported as a network one
+        self.errors = {}
+        if use_udp and polled:
+            self.prober = udp.Prober(timestamps=timestamps,
+                                     src_ports=src_ports)
+            self.method = functools.partial(
+                ping.send_udp_polled, prober=self.prober, pacer=self.pacer)
+            self.batched = True
+        elif use_udp:
+            self.method = functools.partial(ping.send_udp,
+                                            sequenced=sequenced,
+                                            timestamps=timestamps,
+                                            pacer=self.pacer,
+                                            senders=self.senders)
+        self.metrics = metrics.MetricsTable(history)
         self.config = config
         for dst_ip, tags in self.config.targets:
             logging.info('Creating metrics for %s: %s', dst_ip, tags)
-            self.metrics.setdefault(
-                dst_ip, metrics.Metrics(**dict(tags)))
+            self.metrics.add_target(dst_ip, tags)
+        # Held while changing targets or the running state of a cycle
+        self._lock = threading.Lock()
+        self._pending = None
+        # {host: job} of the last probes submitted for each host, which may
+        # still be running after their collection gave up on them
+        self._inflight = {}
+
+    def reconfigure(self, config):
+        """Switch to a new set of targets, keeping unchanged ones as is.
+
+        Targets whose tags changed are removed and added again. The change
+        is never made during a collection; if one is running, it's made as
+        soon as the collection finishes.
+
+        Args:
+            config: (config.CollectorConfig) of targets
+
+        Returns:
+            (tuple) of (targets added, targets removed), or None when the
+            change was deferred until the running collection finishes
+        """
+        with self._lock:
+            if self.cycles.running:
+                logging.info('Reconfiguring after the running collection')
+                self._pending = config
+                return None
+            return self._reconfigure(config)
+
+    def _reconfigure(self, config):
+        """Apply a new config; must be called with the lock held."""
+        self._pending = None
+        new = dict(config.targets)
+        old = dict(self.config.targets)
+        removed = [x for x in old if new.get(x) != old[x]]
+        added = [x for x in new if old.get(x) != new[x]]
+        for dst_ip in removed:
+            logging.info('Removing metrics for %s', dst_ip)
+            self.metrics.remove(dst_ip)
+            self.errors.pop(dst_ip, None)
+            self._inflight.pop(dst_ip, None)
+            sender = self.senders.pop(dst_ip, None)
+            if sender is not None:
+                sender[0].close()
+        for dst_ip in added:
+            logging.info('Creating metrics for %s: %s', dst_ip, new[dst_ip])
+            self.metrics.add_target(dst_ip, new[dst_ip])
+        self.config = config
+        logging.info('Reconfigured with %s targets added and %s removed',
+                     len(added), len(removed))
+        return len(added), len(removed)
+
+    def rate(self, count, duration):
+        """Returns the per-target probe rate to spread probes over duration.
+
+        Unbatched methods probe at most ``workers`` targets at a time, so
+        each wave of targets only gets its share of the duration.
+
+        Args:
+            count: (int) number of datagrams to send each host
+            duration: (float) seconds to spread probes across, or None
+
+        Returns:
+            (float) probes per second for each target, or None for no limit
+        """
+        if not self.paced or not duration:
+            return None
+        waves = 1
+        if not self.batched:
+            waves = int(math.ceil(len(self.metrics) /
+                                  float(self.workers))) or 1
+        return count * waves / float(duration)
+
+    def schedule(self, window=None):
+        """Returns when each host should be probed within a collection.
+
+        Every host gets a stable offset into the window from a hash of the
+        host and ``seed``, so probes are spread evenly instead of all sent at
+        once, each host is probed at the same point of every collection, and
+        collectors with different seeds don't hit a host at the same moment.
+        Batched methods probe hosts in ``STAGGER_SLOTS`` groups instead.
+
+        Args:
+            window: (float) seconds to spread hosts across, or None
+
+        Returns:
+            list of (offset in seconds, [hosts]) in order of offset
+        """
+        hosts = list(self.metrics.keys())
+        if not window:
+            return [(0.0, hosts)]
+        slots = {}
+        for host in hosts:
+            offset = stagger_offset(host, window, self.seed)
+            if self.batched:
+                slot = int(offset / window * self.STAGGER_SLOTS)
+                offset = slot * window / self.STAGGER_SLOTS
+            slots.setdefault(offset, []).append(host)
+        return sorted(slots.items())
 
     def collect(self, count, dst_port=util.DEFAULT_DST_PORT,
-                timeout=util.DEFAULT_TIMEOUT):
+                timeout=util.DEFAULT_TIMEOUT, duration=None, window=None,
+                deadline=None):
         """Collects latency against a set of hosts.
 
         Args:
             count: (int) number of datagrams to send each host
             timeout: (float) seconds to wait for probes to return
+            duration: (float) seconds to spread each host's UDP probes across
+                      instead of sending them as fast as possible
+            window: (float) seconds to stagger the start of each host's
+                    probes across, see schedule()
+            deadline: (float) seconds from the start of each host's probes
+                      after which a host which hasn't returned results is
+                      given up on and marked stale
+
+        Results are stored in each host's metrics as soon as they arrive.
+        Hosts whose probes from an earlier collection are still running
+        aren't probed again, and are marked stale.
+        """
+        kwargs = {}
+        rate = self.rate(count, duration)
+        if rate:
+            kwargs['rate'] = rate
+        with self._lock:
+            if self._pending is not None:
+                self._reconfigure(self._pending)
+            self.cycles.begin(len(self.metrics))
+        start = time.time()
+        try:
+            if self.shards:
+                self._collect_sharded(start, count, dst_port, timeout,
+                                      duration, window, deadline)
+            elif self.batched:
+                self._collect_batched(start, count, dst_port, timeout,
+                                      window, deadline, kwargs)
+            else:
+                self._collect_jobs(start, count, dst_port, timeout, window,
+                                   deadline, kwargs)
+        finally:
+            with self._lock:
+                self.cycles.end()
+                if self._pending is not None:
+                    self._reconfigure(self._pending)
+
+    def _collect_batched(self, start, count, dst_port, timeout, window,
+                         deadline, kwargs):
+        """Probe each slot of hosts with one call of a batched method."""
+        flows = {}
+        for offset, hosts in self.schedule(window):
+            time.sleep(max(start + offset - time.time(), 0))
+            logging.info('Probing %s target hosts', len(hosts))
+            if deadline:
+                kwargs['deadline'] = start + offset + deadline
+            results = self.method(hosts, count=count, port=dst_port,
+                                  timeout=timeout, **kwargs)
+            done = set()
+            for result in results:
+                self.record(result)
+                self.cycles.targets_done += 1
+                done.add(result.target)
+            self.expire([x for x in hosts if x not in done])
+            if self.prober is not None:
+                flows.update(self.prober.flow_stats)
+        self.flows = flows
+
+    def _collect_jobs(self, start, count, dst_port, timeout, window,
+                      deadline, kwargs):
+        """Probe each host in a job of its own on the executor.
+
+        Jobs are submitted at their hosts' offsets while the results of
+        earlier ones are recorded. Each job is given up on ``deadline``
+        seconds after it was due to start.
+        """
+        if self.executor is None:
+            self.executor = futures.ThreadPoolExecutor(
+                max_workers=self.workers)
+        slots = collections.deque(self.schedule(window))
+        finished = Queue.Queue()
+        jobs = {}  # job -> host, until recorded or given up on
+        # (due time, job) in order of submission, so of due time
+        dues = collections.deque()
+        while slots or jobs:
+            now = time.time()
+            while slots and start + slots[0][0] <= now:
+                offset, hosts = slots.popleft()
+                for host in hosts:
+                    previous = self._inflight.get(host)
+                    if previous is not None and not previous.done():
+                        logging.warning('Probes of %s from an earlier '
+                                        'collection are still running',
+                                        host)
+                        self.expire([host])
+                        continue
+                    logging.info('Assigning target host: %s', host)
+                    job = self.executor.submit(self.method, host,
+                                               count=count, port=dst_port,
+                                               timeout=timeout, **kwargs)
+                    self._inflight[host] = job
+                    jobs[job] = host
+                    job.add_done_callback(finished.put)
+                    if deadline:
+                        dues.append((start + offset + deadline, job))
+            late = []
+            while dues and (dues[0][1] not in jobs or dues[0][0] <= now):
+                _, job = dues.popleft()
+                if job in jobs:
+                    # Jobs which already started can't be cancelled and
+                    # their results will be dropped.
+                    job.cancel()
+                    late.append(jobs.pop(job))
+            self.expire(late)
+            wakes = [start + slots[0][0]] if slots else []
+            if dues:
+                wakes.append(dues[0][0])
+            if not jobs and not wakes:
+                break
+            try:
+                job = finished.get(
+                    timeout=max(min(wakes) - now, 0) if wakes else None)
+            except Queue.Empty:
+                continue
+            host = jobs.pop(job, None)
+            if host is None:
+                continue
+            try:
+                result = job.result()
+            except Exception:
+                logging.exception('Failed to probe %s', host)
+                self.expire([host])
+                continue
+            self.record(result)
+            self.cycles.targets_done += 1
+
+    def _collect_sharded(self, start, count, dst_port, timeout, duration,
+                         window, deadline):
+        """Have every shard collect from its hosts, and merge the results.
+
+        Hosts a shard returned no results for, because it missed the
+        deadline, died or hung, are marked stale. A shard which hasn't
+        replied ``Shard.GRACE`` seconds after the last host's deadline is
+        restarted.
+        """
+        hosts = [[] for _ in self.shards]
+        for host in self.metrics.keys():
+            hosts[shard_of(host, len(self.shards))].append(host)
+        args = (count, dst_port, timeout, duration, window, deadline)
+        for shard, shard_hosts in zip(self.shards, hosts):
+            logging.info('Assigning %s target hosts to shard %s',
+                         len(shard_hosts), shard.index)
+            shard.send(shard_hosts, args)
+        due = None
+        if deadline:
+            due = start + (window or 0) + deadline + Shard.GRACE
+        flows = {}
+        for shard, shard_hosts in zip(self.shards, hosts):
+            wait = None if due is None else max(due - time.time(), 0)
+            results, shard_flows = shard.receive(wait)
+            done = set()
+            for result in results:
+                self.record(result)
+                self.cycles.targets_done += 1
+                done.add(result.target)
+            self.expire([x for x in shard_hosts if x not in done])
+            flows.update(shard_flows)
+        self.flows = flows
+
+    def close(self):
+        """Stop any worker processes."""
+        for shard in self.shards:
+            shard.stop()
+
+    def expire(self, hosts):
+        """Mark hosts which missed the deadline as stale.
+
+        Args:
+            hosts: (list) of hosts whose metrics weren't updated
         """
-        jobs = []
-        with futures.ThreadPoolExecutor(max_workers=50) as executor:
-            for host in self.metrics.keys():
-                logging.info('Assigning target host: %s', host)
-                jobs.append(executor.submit(self.method, host,
-                                            count=count,
-                                            port=dst_port,
-                                            timeout=timeout,
-                                           ))
-        for job in futures.as_completed(jobs):
-            loss, rtt, host = job.result()
-            self.metrics[host].loss = loss
-            self.metrics[host].rtt = rtt
-            logging.info('Summary {:16}:{:>3}% loss, {:>4} ms rtt'.format(
-                host, loss, rtt))
+        if not hosts:
+            return
+        logging.warning('Deadline passed before results for %s target '
+                        'hosts', len(hosts))
+        for host in hosts:
+            logging.debug('Marking results for %s stale', host)
+            self.metrics.set_stale(host)
+        self.cycles.targets_stale += len(hosts)
+
+    def record(self, result):
+        """Store the results of probing one target in its metrics.
+
+        Args:
+            result: (ping.ProbeResults) or (ping.UdpProbeResults)
+        """
+        error = getattr(result, 'error', None)
+        if error:
+            self.errors[result.target] = error
+        else:
+            self.errors.pop(result.target, None)
+        values = {'loss': result.loss, 'rtt': result.avg}
+        stats = getattr(result, 'stats', None)
+        if stats is not None:
+            values.update(rtt_p50=stats.rtt_p50, rtt_p90=stats.rtt_p90,
+                          rtt_p99=stats.rtt_p99, rtt_p999=stats.rtt_p999)
+        elif error:
+            values.update(rtt_p50=None, rtt_p90=None, rtt_p99=None,
+                          rtt_p999=None)
+        self.metrics.update(result.target, **values)
+        self.metrics.set_stale(result.target, False)
+        self.metrics.snapshot(result.target)
+        if error:
+            logging.info('Summary {:16}: {}'.format(result.target, error))
+            return
+        logging.info('Summary {:16}:{:>3}% loss, {:>4} ms rtt'.format(
+            result.target, result.loss, result.avg))
 
     @property
     def stats(self):
-        return [x.as_dict for x in self.metrics.values()]
+        return self.metrics.as_dicts
 
     @property
-    def stats_influx(self):
+    def stats_flows(self):
         points = []
-        for metric in self.metrics.values():
-            points.extend(metric.as_influx)
+        for (dst_ip, tos, src_port), stats in sorted(self.flows.iteritems()):
+            point = {'dst_ip': dst_ip, 'tos': tos, 'src_port': src_port}
+            point.update(stats._asdict())
+            points.append(point)
         return points
 
+    @property
+    def stats_influx(self):
+        return self.metrics.as_influx
+
+
+class ShardCollection(Collection):
+    """Probes one shard of targets in a worker process.
+
+    Results are kept for the parent process to store, rather than stored in
+    metrics of its own.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ShardCollection, self).__init__(*args, **kwargs)
+        self.results = []
+
+    def record(self, result):
+        self.results.append(result)
+
+
+def _shard_main(conn, options):
+    """Runs collections in a worker process as the parent requests them.
+
+    Args:
+        conn: (multiprocessing.Connection) to the parent process
+        options: (dict) of keyword arguments for ShardCollection
+    """
+    # Signals are for the parent, which stops us when it exits
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    collection = ShardCollection(config.CollectorConfig(), **options)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        hosts, args = message
+        collection.reconfigure(ShardTargets([(x, ()) for x in hosts]))
+        collection.results = []
+        try:
+            collection.collect(*args)
+        except Exception:
+            logging.exception('Collection failed')
+        conn.send((collection.results, collection.flows))
+
+
+class Shard(object):
+    """A worker process probing a shard of the Collection's targets.
+
+    Each cycle the parent sends the shard its hosts and collect() arguments
+    over a pipe, and gets back the probe results and flow stats.
+    """
+
+    # Seconds a shard may take to reply after the collection's deadline
+    GRACE = 10.0
+
+    def __init__(self, index, options):
+        """Constructor.
+
+        Args:
+            index: (int) of the shard
+            options: (dict) of keyword arguments for ShardCollection
+        """
+        self.index = index
+        self.options = options
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        """Start the worker process."""
+        conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_shard_main, args=(child, self.options),
+            name='llama-shard-%s' % self.index)
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.conn = conn
+        logging.info('Started shard %s as pid %s', self.index,
+                     self.process.pid)
+
+    def send(self, hosts, args):
+        """Ask the worker to collect, restarting it if it died.
+
+        Args:
+            hosts: (list) of hosts to probe
+            args: (tuple) of arguments for Collection.collect()
+        """
+        if not self.process.is_alive():
+            logging.error('Shard %s exited with %s, restarting it',
+                          self.index, self.process.exitcode)
+            self.conn.close()
+            self.start()
+        self.conn.send((hosts, args))
+
+    def receive(self, timeout=None):
+        """Wait for the results of a collection.
+
+        A worker which doesn't reply within the timeout is assumed to be
+        hung and is killed; it's restarted for the next collection.
+
+        Args:
+            timeout: (float) seconds to wait, or None to wait indefinitely
+
+        Returns:
+            (tuple) of ([ping.ProbeResults], {flow: udp.UdpStats}); empty
+            if the worker died or timed out
+        """
+        try:
+            if timeout is not None and not self.conn.poll(timeout):
+                logging.error('Shard %s sent no results in %.1fs, killing it',
+                              self.index, timeout)
+                self.process.terminate()
+                self.process.join(1)
+                return [], {}
+            return self.conn.recv()
+        except (EOFError, IOError) as exc:
+            logging.error('Lost results from shard %s: %s', self.index,
+                          exc or 'exited')
+            return [], {}
+
+    def stop(self):
+        """Stop the worker process."""
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        self.process = None
+
+
+class Payload(object):
+    """A response body, compressed once."""
+
+    def __init__(self, version, body):
+        """Constructor.
+
+        Args:
+            version: (int) of the data the payload was made from
+            body: (str) serialized data
+        """
+        self.version = version
+        self.body = body
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz:
+            gz.write(self.body)
+        self.gzipped = buf.getvalue()
+
 
 class HttpServer(flask.Flask):
     """Our HTTP/API server."""
 
     EXECUTORS = {
         'default': ThreadPoolExecutor(20),
-        'processpool': ProcessPoolExecutor(5)
     }
 
     def __init__(self, name, ip, port, *args, **kwargs):
@@ -103,30 +762,114 @@ class HttpServer(flask.Flask):
         logging.debug('Setting root_path for Flask: %s', root_path)
         self.root_path = root_path
         self.targets = config.CollectorConfig()
+        self.config_path = None
+        self.config_cache_path = None
+        self.peers = None
+        self.peer = None
         self.ip = ip
         self.port = port
         self.start_time = time.time()
         self.setup_time = 0
         self.scheduler = BackgroundScheduler(
             daemon=True, executors=self.EXECUTORS)
+        self.scheduler.add_listener(
+            self.skipped_listener, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
         self.collection = None
+        self.workers = None
+        self.payloads = {}  # name -> Payload
         self.add_url_rule('/', 'index', self.index_handler)
         self.add_url_rule('/status', 'status', self.status_handler)
         self.add_url_rule('/latency', 'latency', self.latency_handler)
         self.add_url_rule('/influxdata', 'influxdata', self.influxdata_handler)
+        self.add_url_rule('/influxdata.line', 'influxdata.line',
+                          self.influxdata_line_handler)
+        self.add_url_rule('/flows', 'flows', self.flows_handler)
+        self.add_url_rule('/errors', 'errors', self.errors_handler)
+        self.add_url_rule('/history', 'history', self.history_handler)
+        self.add_url_rule('/reload', 'reload', self.reload_handler,
+                          methods=['GET', 'POST'])
         self.add_url_rule('/quitquit', 'quitquit', self.shutdown_handler)
         logging.info('Starting Llama Collector, version %s', __version__)
 
-    def configure(self, filepath):
+    def configure(self, filepath, cache_path=None, peers=None, peer=None):
         """Configure the Collector from file.
 
         Args:
             filepath: (str) where the configuration is located
+            cache_path: (str) where to cache the parsed configuration
+            peers: (list) of collectors sharing the targets, if any
+            peer: (str) name of this collector among its peers
+
+        Raises:
+            config.Error: if the configuration is invalid
+        """
+        self.targets = config.CollectorConfig(peers, peer)
+        self.targets.load(filepath, cache_path)
+        self.config_path = filepath
+        self.config_cache_path = cache_path
+        self.peers = peers
+        self.peer = peer
+
+    def reload(self):
+        """Reload targets from the configuration file.
+
+        Only targets which were added, removed or had their tags changed are
+        touched; see Collection.reconfigure().
+
+        Returns:
+            (tuple) of (targets added, targets removed), or None when the
+            change was deferred until the running collection finishes
+
+        Raises:
+            config.Error: if the configuration is invalid
+            IOError: if the configuration can't be read
         """
-        self.targets.load(filepath)
+        targets = config.CollectorConfig(self.peers, self.peer)
+        targets.load(self.config_path, self.config_cache_path)
+        self.targets = targets
+        if self.collection is None:
+            return None
+        return self.collection.reconfigure(targets)
+
+    def sighup_handler(self, signum, frame):
+        logging.info('SIGHUP received, reloading %s', self.config_path)
+        try:
+            self.reload()
+        except Exception:
+            # Raising here would raise in whatever the main thread was doing
+            logging.exception('Failed to reload configuration')
+
+    def reload_handler(self):
+        try:
+            changes = self.reload()
+        except Exception as exc:
+            logging.exception('Failed to reload configuration')
+            return flask.Response(str(exc), status=500, mimetype='text/plain')
+        data = {'deferred': changes is None}
+        if changes is not None:
+            data['added'], data['removed'] = changes
+        return flask.Response(json.dumps(data), mimetype='application/json')
+
+    def skipped_listener(self, event):
+        """Count collections APScheduler skipped instead of running."""
+        if self.collection is None:
+            return
+        if event.code == EVENT_JOB_MAX_INSTANCES:
+            self.collection.cycles.overlapped += 1
+            logging.warning('Skipped a collection; the previous one is '
+                            'still running')
+        else:
+            self.collection.cycles.missed += 1
+            logging.warning('Missed a collection scheduled for %s',
+                            event.scheduled_run_time)
 
     def status_handler(self):
-        return flask.Response('ok', mimetype='text/plain')
+        lines = ['ok']
+        if self.collection is not None:
+            cycles = self.collection.cycles.as_dict
+            lines.extend('cycle_%s: %s' % (key, cycles[key])
+                         for key in sorted(cycles))
+        return flask.Response('\n'.join(lines), mimetype='text/plain')
 
     def index_handler(self):
         return flask.render_template(
@@ -138,18 +881,69 @@ class HttpServer(flask.Flask):
             uptime=humanfriendly.format_timespan(
                 time.time() - self.start_time))
 
+    def cached_response(self, name, render, mimetype='application/json'):
+        """Respond with a payload which is only rebuilt when metrics change.
+
+        Supports conditional requests with ETag/If-None-Match, and gzip
+        Content-Encoding for clients which accept it.
+
+        Args:
+            name: (str) of the payload
+            render: callable returning the serialized body
+            mimetype: (str) of the body
+        """
+        version = self.collection.metrics.version
+        payload = self.payloads.get(name)
+        if payload is None or payload.version != version:
+            payload = Payload(version, render())
+            self.payloads[name] = payload
+        if flask.request.accept_encodings['gzip']:
+            response = flask.Response(payload.gzipped, mimetype=mimetype)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(payload.etag + '-gzip')
+        else:
+            response = flask.Response(payload.body, mimetype=mimetype)
+            response.set_etag(payload.etag)
+        response.vary.add('Accept-Encoding')
+        return response.make_conditional(flask.request)
+
     def latency_handler(self):
-        data = json.dumps(self.collection.stats, indent=4)
-        return flask.Response(data, mimetype='application/json')
+        return self.cached_response(
+            'latency', lambda: self.collection.metrics.as_json)
 
     def influxdata_handler(self):
-        data = json.dumps(self.collection.stats_influx, indent=4)
+        return self.cached_response(
+            'influxdata', lambda: self.collection.metrics.as_influx_json)
+
+    def influxdata_line_handler(self):
+        return self.cached_response(
+            'influxdata.line', lambda: self.collection.metrics.as_influx_line,
+            mimetype='text/plain')
+
+    def history_handler(self):
+        since = flask.request.args.get('since')
+        if since is not None:
+            try:
+                since = float(since)
+            except ValueError:
+                flask.abort(400)
+        data = json.dumps(self.collection.metrics.as_history(since), indent=4)
+        return flask.Response(data, mimetype='application/json')
+
+    def errors_handler(self):
+        data = json.dumps(self.collection.errors, indent=4)
+        return flask.Response(data, mimetype='application/json')
+
+    def flows_handler(self):
+        data = json.dumps(self.collection.stats_flows, indent=4)
         return flask.Response(data, mimetype='application/json')
 
     def shutdown_handler(self):
         """Shuts down the running web server and other things."""
         logging.warn('/quitquit request, attempting to shutdown server...')
         self.scheduler.shutdown(wait=False)
+        if self.collection is not None:
+            self.collection.close()
         fn = flask.request.environ.get('werkzeug.server.shutdown')
         if not fn:
             raise Error('Werkzeug (Flask) server NOT running.')
@@ -158,7 +952,9 @@ class HttpServer(flask.Flask):
 
     def run(self, interval, count, use_udp=False,
             dst_port=util.DEFAULT_DST_PORT, timeout=util.DEFAULT_TIMEOUT,
-            *args, **kwargs):
+            sequenced=False, polled=False, timestamps=False, pps=0,
+            spread=0, src_ports=None, workers=50, stagger=0, deadline=None,
+            history=0, processes=0, *args, **kwargs):
         """Start all the polling and run the HttpServer.
 
         Args:
@@ -167,13 +963,34 @@ class HttpServer(flask.Flask):
             use_udp:   utilize UDP probes for testing
             dst_port:  port to use for testing (only UDP)
             timeout:  how long to wait for probes to return
+            sequenced:  send UDP probes over one socket per target
+            polled:  send UDP probes for all targets from one thread
+            timestamps:  use kernel receive timestamps for UDP RTT
+            pps:  limit on UDP probes per second across all targets
+            spread:  fraction of the interval to spread UDP probes across
+            src_ports:  UDP source ports to sweep for per-flow stats
+            workers:  number of targets probed at once, unless polled
+            stagger:  fraction of the interval to stagger targets across
+            deadline:  seconds from the start of each target's probes
+                       before it's marked stale, see cycle_timing()
+            history:  number of results kept for each target at /history
+            processes:  number of worker processes to shard targets across
         """
         self.interval = interval
+        # Kept for the life of the server instead of once per collection
+        self.workers = futures.ThreadPoolExecutor(max_workers=workers)
+        # Before any threads are started, as shards are forked from here
+        self.collection = Collection(self.targets, use_udp, sequenced, polled,
+                                     timestamps, pps, src_ports, workers,
+                                     self.workers, interval, history=history,
+                                     processes=processes)
+        signal.signal(signal.SIGHUP, self.sighup_handler)
         self.scheduler.start()
-        self.collection = Collection(self.targets, use_udp)
+        window, deadline = cycle_timing(interval, stagger, deadline)
         self.scheduler.add_job(self.collection.collect, 'interval',
                                seconds=interval,
-                               args=[count, dst_port, timeout])
+                               args=[count, dst_port, timeout,
+                                     interval * spread, window, deadline])
         super(HttpServer, self).run(
             host=self.ip, port=self.port, threaded=True, *args, **kwargs)
         self.setup_time = round(time.time() - self.start_time, 0)
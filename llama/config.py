@@ -4,9 +4,17 @@ This is mostly used by the Collector process to determine target hosts and
 tag mappings.
 """
 
+import array
+import bisect
 import collections
+import hashlib
 import ipaddress
+import itertools
 import logging
+import marshal
+import os
+import socket
+import struct
 import yaml
 
 
@@ -16,6 +24,9 @@ class Error(Exception):
 
 Tag = collections.namedtuple('Tag', ['key', 'value'])
 
+# The C (libyaml) loader is many times faster, when PyYAML was built with it
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 def validate_ip(addr):
     """Pass-through function for validating an IPv4 address.
@@ -35,46 +46,250 @@ def validate_ip(addr):
         raise Error('Invalid IPv4 address "%s"; %s' % (addr, exc))
 
 
-class Target(object):
-    """Configuration for a single LLAMA target.
+def validate_ips(addrs):
+    """Validate many IPv4 addresses at once.
+
+    Well formed dotted quads are checked by inet_pton(), which is far
+    cheaper than building an IPv4Address each; anything else falls back to
+    validate_ip() for its error message.
+
+    Args:
+        addrs: (iterable) of IP addresses
+
+    Returns:
+        array of the addresses as unsigned 32-bit integers
 
-    On a decently sized deployment, we'd expect ~1000 or ~10,000 targets, so
-    we'll use __slots__ to save memory at scale.
+    Raises:
+        Error: if any IPv4 address is not valid
     """
+    ips = array.array('I')
+    for addr in addrs:
+        try:
+            packed = socket.inet_pton(socket.AF_INET, addr)
+        except (socket.error, TypeError, UnicodeEncodeError):
+            packed = socket.inet_aton(validate_ip(addr))
+        ips.append(struct.unpack('!I', packed)[0])
+    return ips
 
-    __slots__ = ['dst_ip', 'tags']
 
-    def __init__(self, dst, **tags):
-        self.dst_ip = validate_ip(dst)
-        self.tags = []
-        for key, value in tags.iteritems():
-            self.tags.append(Tag(key=key, value=value))
+def _ring_hash(key):
+    return struct.unpack('!Q', hashlib.md5(key).digest()[:8])[0]
 
-    def __repr__(self):
-        return '<Target "%s" with %s tags at %s>' % (
-            self.ip, len(self.tags), hex(id(self)))
+
+class HashRing(object):
+    """Consistent hash ring assigning targets to a fleet of collectors.
+
+    Every peer is placed at ``replicas`` points around a ring, and a target
+    belongs to the first peer at or after the target's own point, so adding
+    or removing one of N peers only moves about 1/N of the targets.
+    """
+
+    __slots__ = ['_points', '_peers']
+
+    def __init__(self, peers, replicas=100):
+        """Constructor.
+
+        Args:
+            peers: (list) of names of the collectors sharing targets
+            replicas: (int) points on the ring for each peer
+
+        Raises:
+            Error: if there are no peers
+        """
+        if not peers:
+            raise Error('A hash ring needs at least one peer')
+        points = sorted((_ring_hash('%s-%s' % (peer, x)), peer)
+                        for peer in set(peers) for x in xrange(replicas))
+        self._points = [point for point, _ in points]
+        self._peers = [peer for _, peer in points]
+
+    def owner(self, ip):
+        """Returns the peer which probes a target.
+
+        Args:
+            ip: (int) IPv4 address of the target
+
+        Returns:
+            (str) name of the peer
+        """
+        index = bisect.bisect_left(self._points,
+                                   _ring_hash(struct.pack('!I', ip)))
+        return self._peers[index % len(self._peers)]
 
 
 class CollectorConfig(object):
+    """Targets of a Collector, kept in a packed form.
+
+    Targets are stored as an array of integer IPs and an array of ids into
+    a list of tag sets, since most targets share a few tag sets. Parsed
+    files can be cached in a binary file, which is reused while the YAML
+    file's modification time, size and hash are unchanged.
+
+    When collectors share one file, each only keeps the targets a HashRing
+    of its peers assigns to it.
+    """
+
+    __slots__ = ['_ips', '_tagset_ids', '_tagsets', '_tagset_index',
+                 '_ring', '_peer']
+
+    # Bumped whenever the cache format changes
+    CACHE_VERSION = 2
+
+    def __init__(self, peers=None, peer=None):
+        """Constructor.
 
-    __slots__ = ['_targets']
+        Args:
+            peers: (list) of names of collectors sharing the targets, or
+                   None to keep every target
+            peer: (str) name of this collector, one of ``peers``
 
-    def __init__(self):
-        self._targets = []
+        Raises:
+            Error: if peer isn't one of the peers
+        """
+        self._ring = None
+        self._peer = peer
+        if peers:
+            if peer not in peers:
+                raise Error('Collector "%s" is not one of its peers %s' % (
+                    peer, ', '.join(peers)))
+            self._ring = HashRing(peers)
+        self._ips = array.array('I')
+        self._tagset_ids = array.array('I')
+        # Most targets share a few tag sets, so each is only kept once
+        self._tagsets = []
+        self._tagset_index = {}  # tag set -> id
 
-    def load(self, filepath):
-        with open(filepath, 'r') as fh:
-            config = yaml.safe_load(fh)
-        for dst in config.keys():
-            self._targets.append(Target(dst, **config[dst]))
+    def _tagset_id(self, tags):
+        tagset_id = self._tagset_index.get(tags)
+        if tagset_id is None:
+            tagset_id = self._tagset_index[tags] = len(self._tagsets)
+            self._tagsets.append(tags)
+        return tagset_id
+
+    def load(self, filepath, cache_path=None):
+        """Load targets from a YAML file.
+
+        Args:
+            filepath: (str) YAML file of targets
+            cache_path: (str) binary cache of the parsed file, used instead
+                        of parsing when it matches the file
+
+        Raises:
+            Error: if the file isn't valid YAML or has invalid targets
+        """
+        with open(filepath, 'rb') as fh:
+            data = fh.read()
+            stat = os.fstat(fh.fileno())
+        key = (self.CACHE_VERSION, stat.st_mtime, stat.st_size,
+               hashlib.sha1(data).hexdigest())
+        if cache_path and self._load_cache(cache_path, key):
+            logging.info('Loaded configuration with %s targets from %s',
+                         len(self._ips), cache_path)
+            self._select()
+            return
+        try:
+            config = yaml.load(data, Loader=_YamlLoader)
+        except yaml.YAMLError as exc:
+            raise Error('Invalid YAML in %s; %s' % (filepath, exc))
+        if not isinstance(config, dict):
+            raise Error('%s is not a mapping of targets to tags' % filepath)
+        dsts = list(config.keys())
+        ips = validate_ips(dsts)
+        tagset_ids = array.array('I')
+        for dst in dsts:
+            tags = config[dst] or {}
+            if not isinstance(tags, dict):
+                raise Error('Tags of %s in %s are not a mapping' % (
+                    dst, filepath))
+            tags = tuple(sorted(Tag(key=key, value=value)
+                                for key, value in tags.iteritems()))
+            tagset_ids.append(self._tagset_id(tags))
+        self._ips.extend(ips)
+        self._tagset_ids.extend(tagset_ids)
         logging.info('Loaded configuration with %s targets',
-                     len(self._targets))
+                     len(self._ips))
+        if cache_path:
+            self._save_cache(cache_path, key)
+        self._select()
+
+    def _select(self):
+        """Drop targets which the hash ring assigns to other peers."""
+        if self._ring is None:
+            return
+        owner = self._ring.owner
+        keep = [x for x, ip in enumerate(self._ips)
+                if owner(ip) == self._peer]
+        logging.info('Probing %s of %s targets as peer %s', len(keep),
+                     len(self._ips), self._peer)
+        self._ips = array.array('I', [self._ips[x] for x in keep])
+        self._tagset_ids = array.array('I', [self._tagset_ids[x]
+                                             for x in keep])
+
+    def _load_cache(self, cache_path, key):
+        """Returns True if targets were loaded from a matching cache."""
+        # marshal only builds plain values, so a tampered cache can't run
+        # code the way a pickle could
+        try:
+            with open(cache_path, 'rb') as fh:
+                cached = marshal.load(fh)
+        except IOError as exc:
+            logging.debug('Not using config cache %s: %s', cache_path, exc)
+            return False
+        except Exception as exc:
+            logging.warning('Not using corrupt config cache %s: %s',
+                            cache_path, exc)
+            return False
+        try:
+            if cached[0] != key:
+                logging.info('Config cache %s is out of date', cache_path)
+                return False
+            _, ips, tagset_ids, tagsets = cached
+            tagsets = [tuple(Tag(*x) for x in tags) for tags in tagsets]
+            cached_ips = array.array('I')
+            cached_ips.fromstring(ips)
+            cached_ids = array.array('I')
+            cached_ids.fromstring(tagset_ids)
+            if (len(cached_ids) != len(cached_ips) or
+                    any(x >= len(tagsets) for x in cached_ids)):
+                raise ValueError('targets and tag sets don\'t match')
+        except Exception as exc:
+            logging.warning('Not using corrupt config cache %s: %s',
+                            cache_path, exc)
+            return False
+        ids = [self._tagset_id(tags) for tags in tagsets]
+        self._ips.extend(cached_ips)
+        if ids == range(len(ids)):
+            self._tagset_ids.extend(cached_ids)
+        else:
+            # Appending to targets loaded earlier, so ids differ
+            self._tagset_ids.extend(array.array('I', [ids[x]
+                                                      for x in cached_ids]))
+        return True
+
+    def _save_cache(self, cache_path, key):
+        """Write the cache atomically, so readers never see part of it."""
+        cached = (key, self._ips.tostring(), self._tagset_ids.tostring(),
+                  [tuple(tuple(x) for x in tags) for tags in self._tagsets])
+        tmp_path = '%s.%s.tmp' % (cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fh:
+                marshal.dump(cached, fh)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError, ValueError) as exc:
+            # ValueError: a tag value marshal can't write, e.g. a YAML date
+            logging.warning('Failed to write config cache %s: %s',
+                            cache_path, exc)
+
+    def __len__(self):
+        return len(self._ips)
 
     def __repr__(self):
         return '<CollectorConfig with %s targets at %s>' % (
-            len(self._targets), hex(id(self)))
+            len(self._ips), hex(id(self)))
 
     @property
     def targets(self):
-        for target in self._targets:
-            yield target.dst_ip, target.tags
+        tagsets = self._tagsets
+        for ip, tagset_id in itertools.izip(self._ips, self._tagset_ids):
+            yield (socket.inet_ntoa(struct.pack('!I', ip)),
+                   tagsets[tagset_id])
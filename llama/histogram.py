@@ -0,0 +1,86 @@
+"""Streaming histogram library for LLAMA
+
+Probe RTTs are aggregated into a fixed number of logarithmically sized
+buckets, so percentiles can be reported with bounded relative error while
+memory stays constant no matter how many probes are recorded.
+"""
+
+import array
+import math
+
+
+class Histogram(object):
+    """Log-bucketed histogram of positive values.
+
+    Bucket ``i`` covers values in [low * growth^i, low * growth^(i+1)), so
+    any percentile is accurate to within ``precision`` of the true value.
+    Values below ``low`` share the first bucket and values above ``high``
+    share the last one; the exact minimum and maximum are tracked separately.
+    """
+
+    __slots__ = ['low', 'high', 'growth', 'counts', 'count', 'total',
+                 'min', 'max', '_log_low', '_log_growth']
+
+    def __init__(self, low=0.01, high=100000.0, precision=0.02):
+        """Constructor.
+
+        Args:
+            low: (float) smallest value tracked precisely
+            high: (float) largest value tracked precisely
+            precision: (float) relative width of each bucket
+        """
+        self.low = low
+        self.high = high
+        self.growth = 1.0 + precision
+        self._log_low = math.log(low)
+        self._log_growth = math.log(self.growth)
+        size = int(math.ceil((math.log(high) - self._log_low) /
+                             self._log_growth)) + 1
+        self.counts = array.array('I', [0]) * size
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value <= self.low:
+            return 0
+        index = int((math.log(value) - self._log_low) / self._log_growth)
+        return min(index, len(self.counts) - 1)
+
+    def add(self, value):
+        """Record a single value."""
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """Returns the value below which ``percent`` of values fall.
+
+        Args:
+            percent: (float) between 0 and 100
+
+        Returns:
+            (float) the bucket's geometric midpoint, clamped to the observed
+            minimum and maximum; None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        value = self.low * self.growth ** (index + 0.5)
+        return min(max(value, self.min), self.max)
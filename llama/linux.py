@@ -0,0 +1,404 @@
+"""Linux socket extensions for LLAMA
+
+Python 2.7's socket module lacks several calls which let us move more
+datagrams per system call. This library binds them through ctypes:
+    * recvmmsg() - receive many datagrams with one system call
+    * sendmmsg() - send many datagrams with one system call
+    * sendmsg() - send a datagram with its own TOS (IP_TOS ancillary data)
+    * recvmsg() - receive a datagram with its kernel timestamp (SO_TIMESTAMPNS)
+    * clock_gettime(CLOCK_MONOTONIC) - a clock which never steps
+
+Bindings are only usable on Linux with a libc that provides them; check
+``MMSG_AVAILABLE`` or ``SENDMSG_AVAILABLE`` before use and fall back to
+regular socket methods otherwise. Kernels which don't accept IP_TOS ancillary
+data fail sends with EINVAL, so callers should fall back on that as well.
+"""
+
+import ctypes
+import ctypes.util
+import math
+import os
+import select
+import socket
+import sys
+import time
+
+
+class Error(Exception):
+    """Top level error."""
+
+
+# recvmmsg() flag: block for the first datagram, then return what's queued
+MSG_WAITFORONE = 0x10000
+# Lets several sockets bind the same port; the kernel spreads flows across them
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# Kernel receive timestamps as a struct timespec; cmsg type matches the option
+SO_TIMESTAMPNS = 35
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+CLOCK_MONOTONIC = 1
+# prctl() option: signal delivered to this process when its parent exits
+PR_SET_PDEATHSIG = 1
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort),
+                ('sin_port', ctypes.c_ushort),
+                ('sin_addr', ctypes.c_ubyte * 4),
+                ('sin_zero', ctypes.c_ubyte * 8)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+
+class cmsghdr(ctypes.Structure):
+    _fields_ = [('cmsg_len', ctypes.c_size_t),
+                ('cmsg_level', ctypes.c_int),
+                ('cmsg_type', ctypes.c_int)]
+
+
+class cmsghdr_int(ctypes.Structure):
+    """Control message carrying a single int, e.g. IP_TOS."""
+    _fields_ = [('cmsg_len', ctypes.c_size_t),
+                ('cmsg_level', ctypes.c_int),
+                ('cmsg_type', ctypes.c_int),
+                ('cmsg_data', ctypes.c_int)]
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    path = ctypes.util.find_library('c')
+    if not path:
+        return None
+    try:
+        libc = ctypes.CDLL(path, use_errno=True)
+    except OSError:
+        return None
+    libc.sendmsg.argtypes = [ctypes.c_int, ctypes.POINTER(msghdr),
+                             ctypes.c_int]
+    libc.sendmsg.restype = ctypes.c_ssize_t
+    libc.recvmsg.argtypes = [ctypes.c_int, ctypes.POINTER(msghdr),
+                             ctypes.c_int]
+    libc.recvmsg.restype = ctypes.c_ssize_t
+    libc.clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    libc.clock_gettime.restype = ctypes.c_int
+    libc.prctl.argtypes = [ctypes.c_int, ctypes.c_ulong]
+    libc.prctl.restype = ctypes.c_int
+    if hasattr(libc, 'recvmmsg') and hasattr(libc, 'sendmmsg'):
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                                  ctypes.c_uint, ctypes.c_int,
+                                  ctypes.c_void_p]
+        libc.recvmmsg.restype = ctypes.c_int
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                                  ctypes.c_uint, ctypes.c_int]
+        libc.sendmmsg.restype = ctypes.c_int
+    return libc
+
+
+_LIBC = _load_libc()
+SENDMSG_AVAILABLE = _LIBC is not None
+RECVMSG_AVAILABLE = _LIBC is not None
+MMSG_AVAILABLE = SENDMSG_AVAILABLE and hasattr(_LIBC, 'recvmmsg')
+_CMSG_ALIGN = ctypes.sizeof(ctypes.c_size_t)
+
+
+def monotonic():
+    """Returns seconds from a clock which never steps.
+
+    Falls back to time.time() where clock_gettime() isn't available.
+    """
+    if _LIBC is None:
+        return time.time()
+    value = timespec()
+    _LIBC.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(value))
+    return value.tv_sec + value.tv_nsec * 1e-9
+
+
+def set_parent_death_signal(signum):
+    """Asks the kernel to send signum to this process when its parent exits.
+
+    Args:
+        signum: (int) signal number, e.g. signal.SIGTERM
+    Returns:
+        (bool) False where prctl() isn't available
+    """
+    if _LIBC is None:
+        return False
+    if _LIBC.prctl(PR_SET_PDEATHSIG, signum) != 0:
+        _raise_errno()
+    return True
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise socket.error(err, os.strerror(err))
+
+
+def _set_tos(cmsg, tos):
+    """Fill in an IP_TOS control message."""
+    cmsg.cmsg_len = cmsghdr_int.cmsg_data.offset + ctypes.sizeof(ctypes.c_int)
+    cmsg.cmsg_level = socket.IPPROTO_IP
+    cmsg.cmsg_type = socket.IP_TOS
+    cmsg.cmsg_data = tos
+
+
+class TosSender(object):
+    """Sends single datagrams with a per-datagram TOS in one system call.
+
+    Setting TOS through ancillary data avoids a setsockopt(IP_TOS) call
+    before each send and leaves the socket's own TOS untouched, so it is safe
+    on shared sockets. Structures are preallocated and reused for each send,
+    so an instance must not be shared between threads.
+    """
+
+    def __init__(self):
+        if not SENDMSG_AVAILABLE:
+            raise Error('sendmsg() is not available')
+        self._name = sockaddr_in()
+        self._name.sin_family = socket.AF_INET
+        self._iov = iovec()
+        self._cmsg = cmsghdr_int()
+        self._hdr = msghdr()
+        self._hdr.msg_name = ctypes.addressof(self._name)
+        self._hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+        self._hdr.msg_iov = ctypes.pointer(self._iov)
+        self._hdr.msg_iovlen = 1
+        self._hdr.msg_control = ctypes.addressof(self._cmsg)
+        self._hdr.msg_controllen = ctypes.sizeof(cmsghdr_int)
+
+    def sendto(self, sock, data, addr, tos):
+        """Like socket.sendto(), with TOS set for this datagram only.
+
+        Args:
+            sock: (socket) to send on
+            data: (str) datagram payload
+            addr: (tuple) of (IPv4 address, port)
+            tos: (int) TOS byte for this datagram
+
+        Returns:
+            (int) the number of bytes sent
+
+        Raises:
+            socket.error: if the system call fails
+        """
+        ctypes.memmove(self._name.sin_addr, socket.inet_aton(addr[0]), 4)
+        self._name.sin_port = socket.htons(addr[1])
+        buf = ctypes.c_char_p(data)
+        self._iov.iov_base = ctypes.cast(buf, ctypes.c_void_p)
+        self._iov.iov_len = len(data)
+        _set_tos(self._cmsg, tos)
+        result = _LIBC.sendmsg(sock.fileno(), self._hdr, 0)
+        if result < 0:
+            _raise_errno()
+        return result
+
+
+class MessageBatch(object):
+    """Preallocated buffers for receiving and sending datagrams in batches.
+
+    Received datagrams stay in place; reply() sends a subset of them back to
+    the addresses they came from without copying payloads, optionally with a
+    TOS for each datagram.
+    """
+
+    def __init__(self, size, bufsize=512):
+        """Constructor.
+
+        Args:
+            size: (int) maximum number of datagrams per system call
+            bufsize: (int) maximum size of each datagram
+        """
+        if not MMSG_AVAILABLE:
+            raise Error('recvmmsg()/sendmmsg() are not available')
+        self.size = size
+        self.bufsize = bufsize
+        self.bufs = [ctypes.create_string_buffer(bufsize)
+                     for _ in range(size)]
+        self.addrs = (sockaddr_in * size)()
+        self._recv_iov = (iovec * size)()
+        self._recv = (mmsghdr * size)()
+        self._send_iov = (iovec * size)()
+        self._send = (mmsghdr * size)()
+        self._send_cmsg = (cmsghdr_int * size)()
+        for i in range(size):
+            self._recv_iov[i].iov_base = ctypes.addressof(self.bufs[i])
+            self._recv_iov[i].iov_len = bufsize
+            hdr = self._recv[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self._recv_iov[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_name = ctypes.addressof(self.addrs[i])
+            self._send[i].msg_hdr.msg_iov = ctypes.pointer(self._send_iov[i])
+            self._send[i].msg_hdr.msg_iovlen = 1
+
+    def recv(self, sock, flags=MSG_WAITFORONE):
+        """Receive up to ``size`` datagrams with one system call.
+
+        Args:
+            sock: (socket) to receive on
+            flags: (int) recvmmsg() flags
+
+        Returns:
+            (int) number of datagrams received
+
+        Raises:
+            socket.error: if the system call fails
+        """
+        for i in range(self.size):
+            self._recv[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+        count = _LIBC.recvmmsg(sock.fileno(), self._recv, self.size, flags,
+                               None)
+        if count < 0:
+            _raise_errno()
+        return count
+
+    def length(self, index):
+        """Returns the length of a received datagram."""
+        return self._recv[index].msg_len
+
+    def data(self, index):
+        """Returns a copy of a received datagram."""
+        return ctypes.string_at(self.bufs[index], self._recv[index].msg_len)
+
+    def reply(self, sock, indexes, tos=None):
+        """Send received datagrams back to where they came from.
+
+        Args:
+            sock: (socket) to send on
+            indexes: (list) of received datagram indexes to send
+            tos: (list) of TOS bytes, one per index, sent as IP_TOS
+                 ancillary data; the socket's TOS is used if None
+
+        Returns:
+            (int) number of datagrams sent
+
+        Raises:
+            socket.error: if the system call fails before anything is sent
+        """
+        for count, index in enumerate(indexes):
+            recv_hdr = self._recv[index].msg_hdr
+            send_hdr = self._send[count].msg_hdr
+            send_hdr.msg_name = recv_hdr.msg_name
+            send_hdr.msg_namelen = recv_hdr.msg_namelen
+            self._send_iov[count].iov_base = self._recv_iov[index].iov_base
+            self._send_iov[count].iov_len = self._recv[index].msg_len
+            if tos is None:
+                send_hdr.msg_control = None
+                send_hdr.msg_controllen = 0
+            else:
+                _set_tos(self._send_cmsg[count], tos[count])
+                send_hdr.msg_control = ctypes.addressof(
+                    self._send_cmsg[count])
+                send_hdr.msg_controllen = ctypes.sizeof(cmsghdr_int)
+        total = len(indexes)
+        sent = 0
+        while sent < total:
+            # sendmmsg() may send fewer than asked; resume where it stopped
+            msgs = ctypes.cast(
+                ctypes.addressof(self._send) + sent * ctypes.sizeof(mmsghdr),
+                ctypes.POINTER(mmsghdr))
+            result = _LIBC.sendmmsg(sock.fileno(), msgs, total - sent, 0)
+            if result < 0:
+                if sent:
+                    return sent
+                _raise_errno()
+            sent += result
+        return sent
+
+
+class TimestampReceiver(object):
+    """Receives datagrams along with their kernel receive timestamps.
+
+    The socket must have SO_TIMESTAMPNS enabled. Kernel timestamps are taken
+    when the datagram arrives, so they don't include time spent waiting for
+    the GIL or the scheduler before Python reads the datagram. Structures are
+    preallocated and reused, so an instance must not be shared between
+    threads.
+    """
+
+    def __init__(self, bufsize=512):
+        if not RECVMSG_AVAILABLE:
+            raise Error('recvmsg() is not available')
+        self._buf = ctypes.create_string_buffer(bufsize)
+        self._name = sockaddr_in()
+        self._iov = iovec(ctypes.addressof(self._buf), bufsize)
+        self._control = ctypes.create_string_buffer(64)
+        self._hdr = msghdr()
+        self._hdr.msg_name = ctypes.addressof(self._name)
+        self._hdr.msg_iov = ctypes.pointer(self._iov)
+        self._hdr.msg_iovlen = 1
+        self._hdr.msg_control = ctypes.addressof(self._control)
+
+    def _timestamp(self):
+        """Returns the SCM_TIMESTAMPNS value from the last receive, or None."""
+        offset = 0
+        base = ctypes.addressof(self._control)
+        while offset + ctypes.sizeof(cmsghdr) <= self._hdr.msg_controllen:
+            cmsg = cmsghdr.from_address(base + offset)
+            if cmsg.cmsg_len < ctypes.sizeof(cmsghdr):
+                break
+            if (cmsg.cmsg_level == socket.SOL_SOCKET and
+                    cmsg.cmsg_type == SCM_TIMESTAMPNS):
+                value = timespec.from_address(
+                    base + offset + ctypes.sizeof(cmsghdr))
+                return value.tv_sec + value.tv_nsec * 1e-9
+            offset += ((cmsg.cmsg_len + _CMSG_ALIGN - 1) //
+                       _CMSG_ALIGN * _CMSG_ALIGN)
+        return None
+
+    def recvfrom(self, sock):
+        """Like socket.recvfrom(), also returning the kernel timestamp.
+
+        The socket's timeout is honored as socket.recvfrom() would.
+
+        Args:
+            sock: (socket) to receive on
+
+        Returns:
+            (tuple) of (data, (ip, port), seconds since the epoch); the
+            timestamp falls back to time.time() if the kernel provided none
+
+        Raises:
+            socket.timeout: if nothing arrived before the socket timeout
+            socket.error: if the system call fails
+        """
+        timeout = sock.gettimeout()
+        if timeout:
+            # poll() rather than select(), which can't wait on descriptors
+            # numbered 1024 or higher
+            poller = select.poll()
+            poller.register(sock.fileno(), select.POLLIN)
+            if not poller.poll(int(math.ceil(timeout * 1000))):
+                raise socket.timeout('timed out')
+        self._hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+        self._hdr.msg_controllen = ctypes.sizeof(self._control)
+        result = _LIBC.recvmsg(sock.fileno(), self._hdr, 0)
+        if result < 0:
+            _raise_errno()
+        stamp = self._timestamp()
+        if stamp is None:
+            stamp = time.time()
+        addr = (socket.inet_ntoa(ctypes.string_at(self._name.sin_addr, 4)),
+                socket.ntohs(self._name.sin_port))
+        return ctypes.string_at(self._buf, result), addr, stamp
@@ -4,10 +4,10 @@ This library supplies a consistent variable naming representation for LAMA
 timeseries data.
 """
 
+import array
 import collections
 import json
 import time
-import weakref
 
 
 class Error(Exception):
@@ -15,70 +15,335 @@ class Error(Exception):
 
 
 class DatapointError(Error):
-    """Problems with Datapoint descriptors."""
+    """Problems with datapoints."""
 
 
 DatapointResults = collections.namedtuple(
     'DatapointResults', ['name', 'value', 'timestamp'])
 
 
-class Datapoint(object):
-    """Descriptor for a single datapoint."""
+# Marks values which were never set, or set to None, in MetricsTable
+_MISSING = float('nan')
 
-    def __init__(self, name):
-        self.name = name
-        self._value = weakref.WeakKeyDictionary()
-        self._time = weakref.WeakKeyDictionary()
 
-    def __set__(self, instance, value):
-        self._value[instance] = value
-        self._time[instance] = int(round(time.time()))
+def _value(value):
+    """Returns None in place of the NaN marking a missing value."""
+    return None if value != value else value
 
-    def __get__(self, instance, cls):
-        try:
-            results = DatapointResults(
-                self.name, self._value[instance], self._time[instance])
-        except KeyError:
-            results = DatapointResults(self.name, None, None)
-        return results
 
-    def __delete__(self, instance):
-        raise DatapointError('Cannot delete datapoint: %s' % instance)
+def _escape(value):
+    """Escape a tag key or tag value for line protocol."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    for char in (',', '=', ' '):
+        value = value.replace(char, '\\' + char)
+    return value
 
 
-class Metrics(object):
-    """A collection of metrics and common operations."""
+def _json_number(value):
+    """Returns a float value as JSON, null in place of NaN."""
+    return 'null' if value != value else repr(value)
 
-    rtt = Datapoint('rtt')
-    loss = Datapoint('loss')
 
-    def __init__(self, **tags):
-        """Constructor
+class TagSet(object):
+    """Tags shared by any number of targets.
+
+    Everything serialization needs from the tags is derived once, when the
+    set is first seen, and shared by every target with the same tags.
+    """
+
+    __slots__ = ['tags', 'line', 'json', 'series']
+
+    def __init__(self, pairs):
+        """Constructor.
 
         Args:
-            tags: (dict) key=value pairs of tags to assign the metric.
+            pairs: (tuple) of (key, value) tags, sorted by key
         """
-        self._tags = tags
+        self.tags = dict(pairs)
+        # Escaped ",key=value" tags for line protocol. Empty values aren't
+        # valid there, so they're left out, as influxdb-python does.
+        self.line = ''.join(',%s=%s' % (_escape(key), _escape(value))
+                            for key, value in pairs
+                            if value is not None and _escape(value))
+        self.json = json.dumps(self.tags, separators=(',', ':'))
+        # Line protocol series key of each datapoint
+        self.series = dict((name, name + self.line)
+                           for name in MetricsTable.DATAPOINTS)
+
+
+class Row(object):
+    """View of one target's row in a MetricsTable.
+
+    Datapoints read and write like attributes, as DatapointResults of
+    (name, value, timestamp).
+    """
+
+    __slots__ = ['_table', '_target']
+
+    def __init__(self, table, target):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_target', target)
 
     @property
     def tags(self):
-        return self._tags
+        return self._table.tags[self._table.index[self._target]]
 
     @property
-    def data(self):
-        data = []
-        for attr, thing in Metrics.__dict__.iteritems():
-            if isinstance(thing, Datapoint):
-                data.append(tuple(self.__getattribute__(attr)))
-        return data
+    def stale(self):
+        return self._table.is_stale(self._target)
+
+    @stale.setter
+    def stale(self, value):
+        self._table.set_stale(self._target, value)
 
     @property
     def as_dict(self):
-        return {'tags': self.tags, 'data': self.data}
+        return self._table.as_dict(self._target)
+
+    def __getattr__(self, name):
+        if name not in self._table.values:
+            raise AttributeError(name)
+        return self._table.get(self._target, name)
+
+    def __setattr__(self, name, value):
+        if name == 'stale':
+            object.__setattr__(self, name, value)
+        else:
+            self._table.update(self._target, **{name: value})
+
+
+class MetricsTable(object):
+    """Columnar store of the latest datapoints for many targets.
+
+    Instead of an object per target, every datapoint is a column held in a
+    contiguous array of floats alongside an array of timestamps, and each
+    target is a row found through ``index``. Memory grows by a few dozen
+    bytes per target, and the dict and InfluxDB views are built for every
+    target in one pass over the columns.
+
+    Values are stored as floats. Datapoints which were never set, or set to
+    None, are read back as None, and never set datapoints have no timestamp.
+
+    With ``history``, every row also has a ring buffer of its last
+    ``history`` snapshots. The buffers are allocated when a row is added, so
+    memory is fixed per target and nothing is allocated per snapshot.
+    """
+
+    DATAPOINTS = ('rtt', 'loss', 'rtt_p50', 'rtt_p90', 'rtt_p99', 'rtt_p999')
+
+    def __init__(self, history=0):
+        """Constructor.
+
+        Args:
+            history: (int) number of snapshots kept for each target
+        """
+        self.history = history
+        # Changes whenever any value does, so views can be cached
+        self.version = 0
+        # Row r's snapshots are at [r * history, (r + 1) * history)
+        self.history_values = dict((name, array.array('d'))
+                                   for name in self.DATAPOINTS)
+        self.history_times = array.array('l')
+        # Snapshots ever taken of each row; the next goes at count % history
+        self.history_counts = array.array('L')
+        self.index = {}  # target -> row
+        self.targets = []
+        self.tags = []
+        self.tagsets = []
+        self._interned = {}  # sorted (key, value) pairs -> TagSet
+        self.values = dict((name, array.array('d'))
+                           for name in self.DATAPOINTS)
+        # Seconds since the epoch each datapoint was set, 0 if never
+        self.times = dict((name, array.array('l'))
+                          for name in self.DATAPOINTS)
+        self.stale = array.array('B')
+
+    def add(self, target, **tags):
+        """Add a row for a target, unless it already has one.
+
+        Args:
+            target: (str) target the row holds datapoints for
+            tags: key=value pairs of tags to assign the target
+
+        Returns:
+            (int) the target's row
+        """
+        return self.add_target(target, tuple(sorted(tags.iteritems())))
+
+    def add_target(self, target, pairs):
+        """Add a row for a target, unless it already has one.
+
+        Targets with equal tags share one TagSet.
+
+        Args:
+            target: (str) target the row holds datapoints for
+            pairs: (tuple) of (key, value) tags sorted by key, as in
+                   config.CollectorConfig.targets
+
+        Returns:
+            (int) the target's row
+        """
+        row = self.index.get(target)
+        if row is not None:
+            return row
+        tagset = self._interned.get(pairs)
+        if tagset is None:
+            tagset = self._interned[pairs] = TagSet(pairs)
+        row = len(self.targets)
+        self.version += 1
+        self.index[target] = row
+        self.targets.append(target)
+        self.tags.append(tagset.tags)
+        self.tagsets.append(tagset)
+        for name in self.DATAPOINTS:
+            self.values[name].append(_MISSING)
+            self.times[name].append(0)
+            self.history_values[name].extend(
+                array.array('d', [_MISSING]) * self.history)
+        self.history_times.extend(array.array('l', [0]) * self.history)
+        self.history_counts.append(0)
+        self.stale.append(0)
+        return row
+
+    def remove(self, target):
+        """Remove the row of a target.
+
+        The last row is moved into its place, so rows of other targets may
+        change, but no column is copied beyond that one row.
+
+        Args:
+            target: (str) target to remove
+        """
+        row = self.index.pop(target)
+        last = len(self.targets) - 1
+        self.version += 1
+        if row != last:
+            moved = self.targets[last]
+            self.index[moved] = row
+            self.targets[row] = moved
+            self.tags[row] = self.tags[last]
+            self.tagsets[row] = self.tagsets[last]
+            for name in self.DATAPOINTS:
+                self.values[name][row] = self.values[name][last]
+                self.times[name][row] = self.times[name][last]
+                self.history_values[name][
+                    row * self.history:(row + 1) * self.history] = (
+                        self.history_values[name][last * self.history:])
+            self.history_times[row * self.history:(row + 1) * self.history] = (
+                self.history_times[last * self.history:])
+            self.history_counts[row] = self.history_counts[last]
+            self.stale[row] = self.stale[last]
+        for column in (self.targets, self.tags, self.tagsets):
+            column.pop()
+        for name in self.DATAPOINTS:
+            self.values[name].pop()
+            self.times[name].pop()
+            del self.history_values[name][last * self.history:]
+        del self.history_times[last * self.history:]
+        self.history_counts.pop()
+        self.stale.pop()
+
+    def snapshot(self, target):
+        """Copy the current datapoints of a target into its history."""
+        if not self.history:
+            return
+        row = self.index[target]
+        slot = (row * self.history +
+                self.history_counts[row] % self.history)
+        for name in self.DATAPOINTS:
+            self.history_values[name][slot] = self.values[name][row]
+        self.history_times[slot] = int(round(time.time()))
+        self.history_counts[row] += 1
+
+    def history_of(self, row, since=None):
+        """Returns the snapshots of a row, oldest first.
+
+        Args:
+            row: (int) row of the target
+            since: (float) only return snapshots taken after this time
+
+        Returns:
+            dict of {'time': [timestamps], name: [values], ...}
+        """
+        result = dict((name, []) for name in ('time',) + self.DATAPOINTS)
+        count = self.history_counts[row]
+        base = row * self.history
+        for seq in xrange(max(0, count - self.history), count):
+            slot = base + seq % self.history
+            timestamp = self.history_times[slot]
+            if since is not None and timestamp <= since:
+                continue
+            result['time'].append(timestamp)
+            for name in self.DATAPOINTS:
+                result[name].append(_value(self.history_values[name][slot]))
+        return result
+
+    def as_history(self, since=None):
+        """Returns the history of every target.
+
+        Args:
+            since: (float) only return snapshots taken after this time
+
+        Returns:
+            list of {'tags': tags, 'history': history_of()} for each target
+        """
+        return [{'tags': self.tags[row],
+                 'history': self.history_of(row, since)}
+                for row in xrange(len(self.targets))]
+
+    def update(self, target, **values):
+        """Set datapoints of a target, all with the current time.
+
+        Args:
+            target: (str) target to update
+            values: name=value pairs of datapoints; None clears a value
+
+        Raises:
+            DatapointError: for names which aren't datapoints
+        """
+        row = self.index[target]
+        now = int(round(time.time()))
+        self.version += 1
+        for name, value in values.iteritems():
+            if name not in self.values:
+                raise DatapointError('Unknown datapoint: %s' % name)
+            self.values[name][row] = (_MISSING if value is None
+                                      else float(value))
+            self.times[name][row] = now
+
+    def get(self, target, name):
+        """Returns a DatapointResults of one datapoint of a target."""
+        row = self.index[target]
+        return DatapointResults(name, _value(self.values[name][row]),
+                                self.times[name][row] or None)
+
+    def is_stale(self, target):
+        return bool(self.stale[self.index[target]])
+
+    def set_stale(self, target, stale=True):
+        """Mark whether the datapoints of a target are out of date."""
+        self.stale[self.index[target]] = int(bool(stale))
+        self.version += 1
+
+    def data(self, row):
+        """Returns a list of (name, value, timestamp) for a row."""
+        return [(name, _value(self.values[name][row]),
+                 self.times[name][row] or None)
+                for name in self.DATAPOINTS]
+
+    def as_dict(self, target):
+        row = self.index[target]
+        return {'tags': self.tags[row], 'data': self.data(row),
+                'stale': bool(self.stale[row])}
 
     @property
-    def as_json(self):
-        return json.dumps(self.as_dict, indent=4)
+    def as_dicts(self):
+        """Returns as_dict() of every target."""
+        return [{'tags': self.tags[row], 'data': self.data(row),
+                 'stale': bool(self.stale[row])}
+                for row in xrange(len(self.targets))]
 
     @property
     def as_influx(self):
@@ -87,17 +352,89 @@ class Metrics(object):
         The returned data is a list of dicts (each dict is one datapoint).
         """
         points = []
-        for name, value, timestamp in self.data:
-            point = {}
-            point.setdefault('measurement', name)
-            point.setdefault('tags', self.tags)
-            try:
-                point.setdefault('fields', {'value': float(value)})
-            except TypeError:
-                point.setdefault('fields', {'value': None})
-            try:
-                point.setdefault('time', timestamp * 1000000000)
-            except TypeError:
-                point.setdefault('time', None)
-            points.append(point)
+        for name in self.DATAPOINTS:
+            values = self.values[name]
+            times = self.times[name]
+            for row, tags in enumerate(self.tags):
+                value = values[row]
+                points.append({
+                    'measurement': name,
+                    'tags': tags,
+                    'fields': {'value': None if value != value else value},
+                    'time': times[row] * 1000000000 or None,
+                })
         return points
+
+    @property
+    def as_influx_line(self):
+        """Returns every datapoint in InfluxDB line protocol.
+
+        Points without a value are left out, as line protocol has no null.
+
+        Returns:
+            (str) one point per line, with nanosecond timestamps
+        """
+        lines = []
+        for name in self.DATAPOINTS:
+            values = self.values[name]
+            times = self.times[name]
+            for row, tagset in enumerate(self.tagsets):
+                value = values[row]
+                if value != value:
+                    continue
+                lines.append('%s value=%r %d000000000\n' % (
+                    tagset.series[name], value, times[row]))
+        return ''.join(lines)
+
+    def _data_json(self, row):
+        return ','.join('["%s",%s,%s]' % (
+            name, _json_number(self.values[name][row]),
+            self.times[name][row] or 'null') for name in self.DATAPOINTS)
+
+    @property
+    def as_json(self):
+        """Returns as_dicts serialized to compact JSON.
+
+        Tags are serialized once per TagSet, so no dicts are built.
+        """
+        return '[%s]' % ','.join(
+            '{"tags":%s,"data":[%s],"stale":%s}' % (
+                tagset.json, self._data_json(row),
+                'true' if self.stale[row] else 'false')
+            for row, tagset in enumerate(self.tagsets))
+
+    @property
+    def as_influx_json(self):
+        """Returns as_influx serialized to compact JSON.
+
+        Tags are serialized once per TagSet, so no dicts are built.
+        """
+        points = []
+        for name in self.DATAPOINTS:
+            values = self.values[name]
+            times = self.times[name]
+            for row, tagset in enumerate(self.tagsets):
+                timestamp = times[row]
+                points.append(
+                    '{"measurement":"%s","tags":%s,"fields":{"value":%s},'
+                    '"time":%s}' % (
+                        name, tagset.json, _json_number(values[row]),
+                        timestamp * 1000000000 if timestamp else 'null'))
+        return '[%s]' % ','.join(points)
+
+    def keys(self):
+        return list(self.targets)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __contains__(self, target):
+        return target in self.index
+
+    def __iter__(self):
+        return iter(self.targets)
+
+    def __getitem__(self, target):
+        if target not in self.index:
+            raise KeyError(target)
+        return Row(self, target)
@@ -3,11 +3,14 @@
 Ping implements different methods of measuring latency between endpoints. Major
 methods available are:
     * hping3 (sub-shell/process)
+    * send_udp (UDP probes against LLAMA reflectors)
+    * send_udp_polled (UDP probes for many targets from one event-loop thread)
 """
 
 import collections
 import logging
 import re
+from llama import resolver
 from llama import udp
 from llama import util
 
@@ -20,6 +23,11 @@ RE_STATS = re.compile(
 
 ProbeResults = collections.namedtuple(
     'ProbeResults', ['loss', 'avg', 'target'])
+# UDP methods also provide the full udp.UdpStats, including RTT percentiles.
+# Targets which couldn't be resolved have no stats, only an error message.
+UdpProbeResults = collections.namedtuple(
+    'UdpProbeResults', ProbeResults._fields + ('stats', 'error'))
+UdpProbeResults.__new__.__defaults__ = (None,)
 
 
 def hping3(target, count=128, *args, **kwargs):
@@ -53,8 +61,21 @@ def hping3(target, count=128, *args, **kwargs):
     return results
 
 
+def _udp_results(target, stats):
+    """Returns the UdpProbeResults of a target's udp.UdpStats.
+
+    When no probes could be sent nothing was measured, which is reported as
+    an error instead of as 0% loss.
+    """
+    if not stats.sent:
+        return UdpProbeResults(None, None, target, None,
+                               'No probes could be sent')
+    return UdpProbeResults(stats.loss, stats.rtt_avg, target, stats)
+
+
 def send_udp(target, count=500, port=util.DEFAULT_DST_PORT, tos=0x00,
-             timeout=util.DEFAULT_TIMEOUT):
+             timeout=util.DEFAULT_TIMEOUT, sequenced=False, timestamps=False,
+             rate=None, pacer=None, senders=None):
     """Sends UDP datagrams crafted for LLAMA reflectors to target host.
 
     Note: Using this method does NOT require `root` privileges.
@@ -65,10 +86,79 @@ def send_udp(target, count=500, port=util.DEFAULT_DST_PORT, tos=0x00,
         port: destination port to use for probes
         tos: hex type-of-service to use for probes
         timeout: seconds to wait for probe to return
+        sequenced: send all probes over one socket, matching replies by
+                   sequence number (requires reflectors supporting it)
+        timestamps: use kernel receive timestamps (and monotonic send times
+                    when sequenced) for RTT
+        rate: maximum probes per second to send target
+        pacer: util.TokenBucket shared between calls to limit the total rate
+        senders: dict kept between calls so each target's sequenced
+                 sender, and so its socket and source port, is reused
+                 instead of recreated. Unsequenced senders bind a socket
+                 per probe, so they are always closed after the call.
 
     Returns:
-        a tuple containing (loss %, RTT average, target host)
+        a tuple containing (loss %, RTT average, target host, udp.UdpStats,
+        error message if the target couldn't be resolved)
+    """
+    settings = (port, count, tos, timeout, sequenced, timestamps, rate, pacer)
+    reuse = senders is not None and sequenced
+    if not reuse:
+        if senders is not None and target in senders:
+            senders.pop(target)[0].close()
+        senders = {}
+    sender, previous = senders.get(target, (None, None))
+    if previous != settings:
+        if sender is not None:
+            sender.close()
+        if sequenced:
+            sender = udp.SequencedSender(target, port, count, tos, timeout,
+                                         timestamps=timestamps, rate=rate,
+                                         pacer=pacer)
+        else:
+            sender = udp.Sender(target, port, count, tos, timeout,
+                                timestamps=timestamps, rate=rate,
+                                pacer=pacer)
+        senders[target] = (sender, settings)
+    try:
+        sender.run()
+    except resolver.Error as exc:
+        logging.error(exc)
+        return UdpProbeResults(None, None, target, None, str(exc))
+    finally:
+        if not reuse:
+            sender.close()
+    return _udp_results(target, sender.stats)
+
+
+def send_udp_polled(targets, count=500, port=util.DEFAULT_DST_PORT, tos=0x00,
+                    timeout=util.DEFAULT_TIMEOUT, prober=None, rate=None,
+                    pacer=None, deadline=None):
+    """Sends UDP datagrams to many target hosts from a single thread.
+
+    Args:
+        targets: list of IP addresses or hostnames of targets
+        count: number of datagrams to send each target
+        port: destination port to use for probes
+        tos: hex type-of-service to use for probes
+        timeout: seconds to wait for probe to return
+        prober: udp.Prober to reuse between calls; one is created if None
+        rate: maximum probes per second to send each target
+        pacer: util.TokenBucket limiting the total probe rate
+        deadline: time.time() after which targets without complete results
+                  are left out of the results
+
+    Returns:
+        a list of tuples containing (loss %, RTT average, target host,
+        udp.UdpStats, error message if the target couldn't be resolved)
     """
-    sender = udp.Sender(target, port, count, tos, timeout)
-    sender.run()
-    return ProbeResults(sender.stats.loss, sender.stats.rtt_avg, target)
+    if prober is None:
+        prober = udp.Prober()
+    stats = prober.run(targets, count, port, (tos,), timeout, rate=rate,
+                       pacer=pacer, deadline=deadline)
+    results = [_udp_results(target, x)
+               for (target, _), x in stats.iteritems()]
+    for target, error in prober.resolve_errors.iteritems():
+        logging.error(error)
+        results.append(UdpProbeResults(None, None, target, None, error))
+    return results
@@ -0,0 +1,87 @@
+"""Hostname resolution library for LLAMA
+
+Probes are sent to targets many times a second, so targets are resolved once
+into a cache which is shared by everything in the process and refreshed
+after a TTL, instead of letting every sendto() do a blocking lookup.
+"""
+
+import logging
+import socket
+import threading
+
+from llama import linux
+
+
+# Seconds a resolved address is cached for
+DEFAULT_TTL = 300
+
+
+class Error(Exception):
+    """Top level error."""
+
+
+class Resolver(object):
+    """Thread-safe TTL-bounded cache of hostname to IPv4 address."""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        """Constructor.
+
+        Args:
+            ttl: (float) seconds to cache each address for
+        """
+        self.ttl = ttl
+        self._cache = {}  # host -> (address, expiry)
+        self._lock = threading.Lock()
+
+    def resolve(self, host):
+        """Returns the IPv4 address of a host.
+
+        Args:
+            host: (str) hostname or IPv4 address
+
+        Returns:
+            (str) IPv4 address
+
+        Raises:
+            Error: if the host can't be resolved
+        """
+        now = linux.monotonic()
+        with self._lock:
+            cached = self._cache.get(host)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        try:
+            infos = socket.getaddrinfo(host, None, socket.AF_INET,
+                                       socket.SOCK_DGRAM)
+        except socket.gaierror as exc:
+            raise Error('Failed to resolve "%s"; %s' % (host, exc))
+        address = infos[0][4][0]
+        if cached is None or cached[0] != address:
+            logging.debug('Resolved %s to %s', host, address)
+        with self._lock:
+            self._cache[host] = (address, now + self.ttl)
+        return address
+
+    def clear(self):
+        """Forget every cached address."""
+        with self._lock:
+            self._cache.clear()
+
+
+# Shared by senders, probers and the collector
+_resolver = Resolver()
+
+
+def resolve(host):
+    """Resolve a host using the process-wide cache.
+
+    Args:
+        host: (str) hostname or IPv4 address
+
+    Returns:
+        (str) IPv4 address
+
+    Raises:
+        Error: if the host can't be resolved
+    """
+    return _resolver.resolve(host)
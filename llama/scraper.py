@@ -38,16 +38,19 @@ def http_get(server, port, uri, **headers):
 class CollectorClient(object):
     """A client for moving data from Collector to TSDB."""
 
-    def __init__(self, server, port):
+    def __init__(self, server, port, line_protocol=False):
         """Constructor.
 
         Args:
             server:  (str) collector server hostname or IP
             port:  (int) collector TCP port
+            line_protocol:  (bool) pass /influxdata.line through to the TSDB
+                            instead of decoding and encoding /influxdata
         """
         logging.info('Created a %s for %s:%s', self, server, port)
         self.server = server
         self.port = port
+        self.line_protocol = line_protocol
 
     def get_latency(self):
         """Gets /influxdata stats from collector.
@@ -65,6 +68,33 @@ class CollectorClient(object):
                           '%s:%s, code=%s' % (self.server, self.port, status))
         return json.loads(data)
 
+    def get_latency_lines(self):
+        """Gets /influxdata.line stats from collector.
+
+        Returns:
+            str of InfluxDB line protocol, one datapoint per line
+        """
+        status, data = http_get(self.server, self.port, '/influxdata.line')
+        if status < 200 or status > 299:
+            raise Error('Error received getting latency from collector: '
+                        '%s:%s, code=%s' % (self.server, self.port, status))
+        return data
+
+    def push_tsdb_lines(self, server, port, database, data):
+        """Push line protocol to influxDB server, exactly as received.
+
+        Args:
+            server: (str) influxDB server hostname or IP
+            port: (int) influxDB server TCP port
+            database: (str) name of LLAMA database
+            data: (str) InfluxDB line protocol
+        """
+        client = influxdb.InfluxDBClient(
+            server, port, database=database)
+        # The client joins and encodes the lines itself
+        lines = [line.decode('utf-8') for line in data.splitlines()]
+        client.write(lines, params={'db': database}, protocol='line')
+
     def push_tsdb(self, server, port, database, points):
         """Push latest datapoints to influxDB server.
 
@@ -80,6 +110,18 @@ class CollectorClient(object):
 
     def run(self, server, port, database):
         """Get and push stats to TSDB."""
+        if self.line_protocol:
+            try:
+                data = self.get_latency_lines()
+            except Error as exc:
+                logging.error(exc)
+                return
+            count = data.count('\n')
+            logging.info('Pulled %s datapoints from collector: %s',
+                         count, self.server)
+            self.push_tsdb_lines(server, port, database, data)
+            logging.info('Pushed %s datapoints to TSDB: %s', count, server)
+            return
         try:
             points = self.get_latency()
         except Error as exc:
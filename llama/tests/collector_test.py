@@ -0,0 +1,393 @@
+"""Unittests for collector lib."""
+
+from llama import collector
+from llama import config
+from llama import ping
+from llama import udp
+from concurrent import futures
+import gzip
+import io
+import json
+import pytest
+import signal
+import threading
+import time
+
+
+def fake_method(host, **kwargs):
+    time.sleep(0.01)
+    return ping.ProbeResults(0.0, 1.0, host)
+
+
+@pytest.fixture
+def targets(tmpdir):
+    path = tmpdir.join('targets.yaml')
+    path.write('''
+10.0.0.1:
+  dst_hostname: host1
+  dst_cluster: c1
+10.0.0.2:
+  dst_hostname: host2
+  dst_cluster: c1
+''')
+    targets = config.CollectorConfig()
+    targets.load(str(path))
+    return targets
+
+
+class TestCollection(object):
+
+    def test_record_udp(self, targets):
+        collection = collector.Collection(targets, use_udp=True)
+        stats = udp.UdpStats(10, 1, 10.0, 3.0, 1.0, 2.0, rtt_p50=2.0,
+                             rtt_p90=2.5, rtt_p99=3.0, rtt_p999=3.0)
+        collection.record(ping.UdpProbeResults(10.0, 2.0, '10.0.0.1', stats))
+        metrics = collection.metrics['10.0.0.1']
+        assert metrics.loss.value == 10.0
+        assert metrics.rtt.value == 2.0
+        assert metrics.rtt_p50.value == 2.0
+        assert metrics.rtt_p99.value == 3.0
+
+    def test_record_hping3(self, targets):
+        collection = collector.Collection(targets)
+        collection.record(ping.ProbeResults('0', '0.1', '10.0.0.2'))
+        metrics = collection.metrics['10.0.0.2']
+        # hping3 reports strings, but they're stored as floats
+        assert metrics.loss.value == 0.0
+        assert metrics.rtt_p50.value is None
+
+    def test_rate(self, targets):
+        collection = collector.Collection(targets, use_udp=True, pps=1000)
+        assert collection.pacer.rate == 1000
+        assert collection.rate(100, None) is None
+        assert collection.rate(100, 10) == 10.0
+        # hping3 probes can't be paced
+        assert collector.Collection(targets).rate(100, 10) is None
+
+    def test_src_ports_require_polled(self, targets):
+        with pytest.raises(collector.Error):
+            collector.Collection(targets, use_udp=True, src_ports=[40000])
+        with pytest.raises(collector.Error):
+            collector.Collection(targets, use_udp=True, polled=True,
+                                 src_ports=[40000], processes=2)
+
+    def test_stats_flows(self, targets):
+        collection = collector.Collection(targets, use_udp=True, polled=True,
+                                          src_ports=[40000])
+        collection.flows = {
+            ('10.0.0.1', 0x00, 40000): udp.UdpStats(4, 1, 25.0, 2.0, 1.0, 1.5),
+        }
+        point, = collection.stats_flows
+        assert point['dst_ip'] == '10.0.0.1'
+        assert point['src_port'] == 40000
+        assert point['loss'] == 25.0
+
+    def test_record_error(self, targets):
+        collection = collector.Collection(targets, use_udp=True)
+        collection.record(ping.UdpProbeResults(
+            None, None, '10.0.0.1', None, 'Failed to resolve'))
+        assert collection.errors == {'10.0.0.1': 'Failed to resolve'}
+        assert collection.metrics['10.0.0.1'].loss.value is None
+        stats = udp.UdpStats(10, 0, 0.0, 3.0, 1.0, 2.0)
+        collection.record(ping.UdpProbeResults(0.0, 2.0, '10.0.0.1', stats))
+        assert collection.errors == {}
+
+    def test_collect_cycles(self, targets):
+        executor = futures.ThreadPoolExecutor(max_workers=2)
+        collection = collector.Collection(targets, executor=executor,
+                                          interval=0.01)
+        collection.method = fake_method
+        collection.collect(1)
+        collection.collect(1)
+        cycles = collection.cycles
+        assert collection.executor is executor
+        assert cycles.count == 2
+        assert not cycles.running
+        assert cycles.targets == cycles.targets_done == 2
+        assert cycles.overruns == 2
+        assert collection.metrics['10.0.0.2'].loss.value == 0.0
+
+    def test_schedule(self, targets):
+        collection = collector.Collection(targets, seed='collector1')
+        (offset, hosts), = collection.schedule()
+        assert offset == 0.0
+        assert sorted(hosts) == ['10.0.0.1', '10.0.0.2']
+        schedule = collection.schedule(10)
+        assert schedule == collection.schedule(10)
+        assert sorted(sum([hosts for _, hosts in schedule], [])) == [
+            '10.0.0.1', '10.0.0.2']
+        for offset, hosts in schedule:
+            assert 0 <= offset < 10
+        # Another collector probes the same hosts at other times
+        other = collector.Collection(targets, seed='collector2')
+        assert other.schedule(10) != schedule
+
+    def test_schedule_batched(self, targets):
+        collection = collector.Collection(targets, use_udp=True, polled=True)
+        for offset, hosts in collection.schedule(10):
+            assert offset in range(0, 10)
+
+    def test_collect_staggered(self, targets):
+        collection = collector.Collection(targets)
+        collection.method = fake_method
+        collection.collect(1, window=0.2)
+        last = max(offset for offset, _ in collection.schedule(0.2))
+        assert collection.cycles.duration >= last
+        assert collection.cycles.targets_done == 2
+
+    def test_cycle_timing(self):
+        assert collector.cycle_timing(30) == (0.0, 30)
+        assert collector.cycle_timing(30, 0.2) == (6.0, 24.0)
+        # The window is cut short so every host's deadline fits
+        assert collector.cycle_timing(30, 1) == (15.0, 15.0)
+        assert collector.cycle_timing(30, 0.5, 20) == (10.0, 20)
+
+    def test_collect_staggered_deadline(self, tmpdir):
+        path = tmpdir.join('many.yaml')
+        path.write(''.join('10.0.0.%s: {}\n' % x for x in range(1, 21)))
+        targets = config.CollectorConfig()
+        targets.load(str(path))
+        collection = collector.Collection(targets)
+        collection.method = fake_method
+        # Deadlines count from each host's offset, not the collection start
+        collection.collect(1, window=0.2, deadline=0.1)
+        assert collection.cycles.targets_done == 20
+        assert collection.cycles.targets_stale == 0
+
+    def test_collect_still_running(self, targets):
+        release = threading.Event()
+        calls = []
+
+        def method(host, **kwargs):
+            calls.append(host)
+            if host == '10.0.0.2':
+                release.wait()
+            return ping.ProbeResults(0.0, 1.0, host)
+
+        collection = collector.Collection(targets)
+        collection.method = method
+        try:
+            collection.collect(1, deadline=0.05)
+            collection.collect(1, deadline=0.05)
+            # The late host isn't probed again while it's still running
+            assert sorted(calls) == ['10.0.0.1', '10.0.0.1', '10.0.0.2']
+            assert collection.cycles.targets_stale == 1
+            assert collection.metrics['10.0.0.2'].stale
+        finally:
+            release.set()
+
+    def test_collect_failed_job(self, targets):
+        def method(host, **kwargs):
+            if host == '10.0.0.2':
+                raise IOError('Too many open files')
+            return ping.ProbeResults(0.0, 1.0, host)
+
+        collection = collector.Collection(targets)
+        collection.method = method
+        collection.collect(1)
+        assert collection.cycles.targets_done == 1
+        assert collection.metrics['10.0.0.1'].loss.value == 0.0
+        assert collection.metrics['10.0.0.2'].stale
+
+    def test_collect_deadline(self, targets):
+        def method(host, **kwargs):
+            if host == '10.0.0.2':
+                time.sleep(0.3)
+            return ping.ProbeResults(0.0, 1.0, host)
+
+        collection = collector.Collection(targets)
+        collection.method = method
+        collection.collect(1, deadline=0.05)
+        assert collection.cycles.duration < 0.3
+        assert collection.cycles.targets_done == 1
+        assert collection.cycles.targets_stale == 1
+        assert not collection.metrics['10.0.0.1'].stale
+        assert collection.metrics['10.0.0.1'].loss.value == 0.0
+        assert collection.metrics['10.0.0.2'].stale
+        assert collection.metrics['10.0.0.2'].loss.value is None
+        # The late result is dropped, but the next one clears the flag
+        collection.record(ping.ProbeResults(0.0, 1.0, '10.0.0.2'))
+        assert not collection.metrics['10.0.0.2'].stale
+
+    def test_shard_of(self):
+        shards = [collector.shard_of('10.0.%s.1' % x, 4) for x in range(100)]
+        assert shards == [collector.shard_of('10.0.%s.1' % x, 4)
+                          for x in range(100)]
+        assert set(shards) == set(range(4))
+
+    def test_collect_sharded(self, targets, monkeypatch):
+        # Shards are forked, so they probe with the patched method
+        monkeypatch.setattr(ping, 'hping3', fake_method)
+        collection = collector.Collection(targets, processes=2)
+        try:
+            assert len(collection.shards) == 2
+            collection.collect(1)
+            assert collection.cycles.targets_done == 2
+            assert collection.metrics['10.0.0.1'].rtt.value == 1.0
+            assert collection.metrics['10.0.0.2'].rtt.value == 1.0
+            # A dead shard is restarted for the next collection
+            collection.shards[0].process.terminate()
+            collection.shards[0].process.join()
+            collection.collect(1)
+            assert collection.cycles.targets_done == 2
+            assert collection.cycles.targets_stale == 0
+        finally:
+            collection.close()
+
+    def test_collect_sharded_hung(self, targets, monkeypatch):
+        def collect(self, *args):
+            # Hangs the shard, as a lock inherited across fork() would
+            signal.pause()
+
+        monkeypatch.setattr(collector.ShardCollection, 'collect', collect)
+        monkeypatch.setattr(collector.Shard, 'GRACE', 0.1)
+        collection = collector.Collection(targets, processes=2)
+        try:
+            start = time.time()
+            collection.collect(1, deadline=0.1)
+            assert time.time() - start < 2
+            assert collection.cycles.targets_stale == 2
+            assert not any(x.process.is_alive() for x in collection.shards)
+        finally:
+            collection.close()
+
+    def test_tagsets_shared(self, tmpdir):
+        path = tmpdir.join('shared.yaml')
+        path.write('''
+10.0.0.1:
+  dst_cluster: c1
+10.0.0.2:
+  dst_cluster: c1
+''')
+        targets = config.CollectorConfig()
+        targets.load(str(path))
+        (_, tags1), (_, tags2) = targets.targets
+        assert tags1 is tags2
+        collection = collector.Collection(targets)
+        assert collection.metrics.tagsets[0] is collection.metrics.tagsets[1]
+
+    def test_reconfigure(self, targets, tmpdir):
+        collection = collector.Collection(targets)
+        collection.record(ping.ProbeResults(0.0, 1.0, '10.0.0.1'))
+        collection.record(ping.ProbeResults(0.0, 1.0, '10.0.0.2'))
+        path = tmpdir.join('new.yaml')
+        path.write('''
+10.0.0.1:
+  dst_hostname: host1
+  dst_cluster: c1
+10.0.0.2:
+  dst_hostname: host2
+  dst_cluster: c2
+10.0.0.3:
+  dst_hostname: host3
+  dst_cluster: c1
+''')
+        new = config.CollectorConfig()
+        new.load(str(path))
+        assert collection.reconfigure(new) == (2, 1)
+        assert sorted(collection.metrics.keys()) == [
+            '10.0.0.1', '10.0.0.2', '10.0.0.3']
+        # Unchanged targets keep their metrics, changed ones start over
+        assert collection.metrics['10.0.0.1'].rtt.value == 1.0
+        assert collection.metrics['10.0.0.2'].rtt.value is None
+        assert collection.metrics['10.0.0.2'].tags['dst_cluster'] == 'c2'
+
+    def test_reconfigure_deferred(self, targets, tmpdir):
+        path = tmpdir.join('new.yaml')
+        path.write('10.0.0.3: {dst_hostname: host3}\n')
+        new = config.CollectorConfig()
+        new.load(str(path))
+        collection = collector.Collection(targets)
+
+        def method(host, **kwargs):
+            # Runs during the collection, so the change waits for it
+            assert collection.reconfigure(new) is None
+            assert host in collection.metrics
+            return ping.ProbeResults(0.0, 1.0, host)
+
+        collection.method = method
+        collection.collect(1)
+        assert collection.metrics.keys() == ['10.0.0.3']
+
+
+class TestHttpServer(object):
+
+    def test_status(self, targets):
+        server = collector.HttpServer(__name__, ip='127.0.0.1', port=0)
+        assert server.test_client().get('/status').data == 'ok'
+        server.collection = collector.Collection(targets)
+        server.collection.cycles.overlapped = 3
+        data = server.test_client().get('/status').data
+        assert data.startswith('ok\n')
+        assert 'cycle_overlapped: 3' in data.splitlines()
+
+    def test_history(self, targets):
+        server = collector.HttpServer(__name__, ip='127.0.0.1', port=0)
+        server.collection = collector.Collection(targets, history=5)
+        server.collection.record(ping.ProbeResults(0.0, 1.0, '10.0.0.1'))
+        client = server.test_client()
+        data = json.loads(client.get('/history').data)
+        assert len(data) == 2
+        for target in data:
+            if target['tags']['dst_hostname'] == 'host1':
+                assert target['history']['rtt'] == [1.0]
+        since = time.time() + 1
+        data = json.loads(client.get('/history?since=%s' % since).data)
+        assert data[0]['history']['rtt'] == []
+        assert client.get('/history?since=yesterday').status_code == 400
+
+    def test_cached_response(self, targets):
+        server = collector.HttpServer(__name__, ip='127.0.0.1', port=0)
+        server.collection = collector.Collection(targets)
+        client = server.test_client()
+        response = client.get('/latency')
+        assert response.status_code == 200
+        assert '\n' not in response.data
+        assert len(json.loads(response.data)) == 2
+        etag = response.headers['ETag']
+        payload = server.payloads['latency']
+        # Unchanged metrics are neither serialized again nor sent again
+        response = client.get('/latency', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert server.payloads['latency'] is payload
+        server.collection.record(ping.ProbeResults(0.0, 1.0, '10.0.0.1'))
+        response = client.get('/latency', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+    def test_gzip_response(self, targets):
+        server = collector.HttpServer(__name__, ip='127.0.0.1', port=0)
+        server.collection = collector.Collection(targets)
+        response = server.test_client().get(
+            '/influxdata', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        data = gzip.GzipFile(fileobj=io.BytesIO(response.data)).read()
+        assert len(json.loads(data)) == 12
+
+    def test_influxdata_line(self, targets):
+        server = collector.HttpServer(__name__, ip='127.0.0.1', port=0)
+        server.collection = collector.Collection(targets)
+        server.collection.record(ping.ProbeResults(0.0, 1.0, '10.0.0.1'))
+        response = server.test_client().get('/influxdata.line')
+        assert response.mimetype == 'text/plain'
+        assert len(response.data.splitlines()) == 2
+        assert response.data.startswith('rtt,dst_cluster=c1,')
+
+    def test_reload(self, targets, tmpdir):
+        path = tmpdir.join('targets.yaml')
+        path.write('10.0.0.1: {dst_hostname: host1}\n')
+        server = collector.HttpServer(__name__, ip='127.0.0.1', port=0)
+        server.configure(str(path))
+        server.collection = collector.Collection(server.targets)
+        path.write('10.0.0.2: {dst_hostname: host2}\n')
+        data = json.loads(server.test_client().post('/reload').data)
+        assert data == {'added': 1, 'removed': 1, 'deferred': False}
+        assert server.collection.metrics.keys() == ['10.0.0.2']
+        path.write('10.0.0.2: [unclosed\n')
+        assert server.test_client().post('/reload').status_code == 500
+        assert server.collection.metrics.keys() == ['10.0.0.2']
+        # An empty or truncated file never escapes the signal handler
+        path.write('')
+        assert server.test_client().post('/reload').status_code == 500
+        server.sighup_handler(signal.SIGHUP, None)
+        assert server.collection.metrics.keys() == ['10.0.0.2']
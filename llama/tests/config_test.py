@@ -0,0 +1,119 @@
+"""Unittests for config lib."""
+
+from llama import config
+import marshal
+import os
+import pytest
+
+
+TARGETS = '''
+10.0.0.1:
+  dst_hostname: host1
+  dst_cluster: c1
+10.0.0.2:
+  dst_hostname: host2
+  dst_cluster: c1
+10.0.0.3:
+  dst_hostname: host2
+  dst_cluster: c1
+'''
+
+
+class TestCollectorConfig(object):
+
+    def test_validate_ips(self):
+        assert list(config.validate_ips(['10.0.0.1', u'0.0.1.0'])) == [
+            0x0a000001, 0x100]
+        with pytest.raises(config.Error):
+            config.validate_ips(['10.0.0.1', '10.0.0.256'])
+
+    def test_load(self, tmpdir):
+        path = tmpdir.join('targets.yaml')
+        path.write(TARGETS)
+        targets = config.CollectorConfig()
+        targets.load(str(path))
+        assert len(targets) == 3
+        loaded = dict(targets.targets)
+        assert loaded['10.0.0.1'] == (('dst_cluster', 'c1'),
+                                      ('dst_hostname', 'host1'))
+        # Equal tag sets are only kept once
+        assert loaded['10.0.0.2'] is loaded['10.0.0.3']
+
+    def test_load_invalid_ip(self, tmpdir):
+        path = tmpdir.join('targets.yaml')
+        path.write('10.0.0:\n  dst_hostname: host1\n')
+        with pytest.raises(config.Error):
+            config.CollectorConfig().load(str(path))
+
+    @pytest.mark.parametrize('data', ['', '- 10.0.0.1\n',
+                                      '10.0.0.1: [c1]\n'])
+    def test_load_not_mapping(self, tmpdir, data):
+        path = tmpdir.join('targets.yaml')
+        path.write(data)
+        targets = config.CollectorConfig()
+        with pytest.raises(config.Error):
+            targets.load(str(path))
+        assert len(targets) == 0
+
+    def test_cache(self, tmpdir, monkeypatch):
+        path = tmpdir.join('targets.yaml')
+        path.write(TARGETS)
+        cache = str(tmpdir.join('targets.cache'))
+        expected = config.CollectorConfig()
+        expected.load(str(path), cache)
+        assert os.path.exists(cache)
+
+        def fail(*args, **kwargs):
+            raise AssertionError('YAML parsed despite a valid cache')
+
+        monkeypatch.setattr(config.yaml, 'load', fail)
+        cached = config.CollectorConfig()
+        cached.load(str(path), cache)
+        assert sorted(cached.targets) == sorted(expected.targets)
+        # A changed file isn't served from the stale cache
+        monkeypatch.undo()
+        path.write(TARGETS + '10.0.0.4: {dst_hostname: host4}\n')
+        changed = config.CollectorConfig()
+        changed.load(str(path), cache)
+        assert len(changed) == 4
+
+    @pytest.mark.parametrize('data', [os.urandom(256),
+                                      marshal.dumps(()),
+                                      marshal.dumps((1, 2)),
+                                      '\x80\x02(K\x01K\x02t.'])
+    def test_corrupt_cache(self, tmpdir, data):
+        path = tmpdir.join('targets.yaml')
+        path.write(TARGETS)
+        cache = tmpdir.join('targets.cache')
+        cache.write(data, mode='wb')
+        targets = config.CollectorConfig()
+        targets.load(str(path), str(cache))
+        assert len(targets) == 3
+
+    def test_peers(self, tmpdir):
+        path = tmpdir.join('targets.yaml')
+        path.write(''.join('10.0.%s.%s: {dst_cluster: c1}\n' % divmod(x, 250)
+                           for x in range(100, 500)))
+        peers = ['collector1', 'collector2', 'collector3']
+        shards = {}
+        for peer in peers:
+            targets = config.CollectorConfig(peers, peer)
+            targets.load(str(path))
+            shards[peer] = set(ip for ip, _ in targets.targets)
+            assert len(shards[peer]) > 50
+        assert sum(len(x) for x in shards.values()) == 400
+        assert len(set.union(*shards.values())) == 400
+        with pytest.raises(config.Error):
+            config.CollectorConfig(peers, 'collector4')
+
+
+class TestHashRing(object):
+
+    def test_add_peer(self):
+        ips = range(0x0a000000, 0x0a000000 + 2000)
+        before = config.HashRing(['0', '1', '2', '3'])
+        after = config.HashRing(['0', '1', '2', '3', '4'])
+        moved = [ip for ip in ips if before.owner(ip) != after.owner(ip)]
+        # Only targets taken by the new peer move, about 1/5 of them
+        assert set(after.owner(ip) for ip in moved) == set(['4'])
+        assert 0.1 < len(moved) / float(len(ips)) < 0.3
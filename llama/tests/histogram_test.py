@@ -0,0 +1,46 @@
+"""Unittests for histogram lib."""
+
+from llama import histogram
+import pytest
+
+
+class TestHistogram(object):
+
+    def test_empty(self):
+        hist = histogram.Histogram()
+        assert hist.mean is None
+        assert hist.percentile(50) is None
+
+    def test_percentiles(self):
+        hist = histogram.Histogram()
+        for value in range(1, 1001):
+            hist.add(float(value))
+        assert hist.count == 1000
+        assert hist.min == 1.0
+        assert hist.max == 1000.0
+        assert hist.mean == 500.5
+        assert hist.percentile(50) == pytest.approx(500, rel=0.02)
+        assert hist.percentile(90) == pytest.approx(900, rel=0.02)
+        assert hist.percentile(99) == pytest.approx(990, rel=0.02)
+        assert hist.percentile(99.9) == pytest.approx(999, rel=0.02)
+        assert hist.percentile(100) == 1000.0
+
+    def test_out_of_range(self):
+        hist = histogram.Histogram(low=1, high=100)
+        hist.add(0.001)
+        hist.add(-1)
+        hist.add(5000)
+        # Out of range values share the outermost buckets
+        assert hist.count == 3
+        assert hist.counts[0] == 2
+        assert hist.counts[-1] == 1
+        assert hist.min == -1
+        assert hist.max == 5000
+        assert hist.percentile(50) == pytest.approx(1, rel=0.02)
+
+    def test_constant_size(self):
+        hist = histogram.Histogram()
+        size = len(hist.counts)
+        for value in range(100000):
+            hist.add(value * 0.01)
+        assert len(hist.counts) == size
@@ -0,0 +1,65 @@
+"""Unittests for linux lib."""
+
+from llama import linux
+import pytest
+import socket
+import time
+
+
+pytestmark = pytest.mark.skipif(not linux.RECVMSG_AVAILABLE,
+                                reason='Linux socket extensions unavailable')
+
+
+@pytest.fixture
+def pair():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(('127.0.0.1', 0))
+    return sender, receiver
+
+
+class TestLinux(object):
+
+    def test_monotonic(self):
+        first = linux.monotonic()
+        second = linux.monotonic()
+        assert second >= first
+
+    def test_timestamp_receiver(self, pair):
+        sender, receiver = pair
+        receiver.setsockopt(socket.SOL_SOCKET, linux.SO_TIMESTAMPNS, 1)
+        before = time.time()
+        sender.sendto('hello', receiver.getsockname())
+        data, addr, stamp = linux.TimestampReceiver().recvfrom(receiver)
+        assert data == 'hello'
+        assert addr == sender.getsockname()
+        assert before - 0.01 <= stamp <= time.time()
+
+    def test_timestamp_receiver_timeout(self, pair):
+        sender, receiver = pair
+        receiver.settimeout(0.01)
+        with pytest.raises(socket.timeout):
+            linux.TimestampReceiver().recvfrom(receiver)
+
+    def test_timestamp_receiver_high_fds(self):
+        # select() can't wait on descriptors numbered 1024 or higher
+        socks = []
+        try:
+            while not socks or socks[-1].fileno() < 1100:
+                socks.append(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+            sender, receiver = socks[-2:]
+            receiver.bind(('127.0.0.1', 0))
+            receiver.settimeout(0.2)
+            sender.sendto('hello', receiver.getsockname())
+            data, _, _ = linux.TimestampReceiver().recvfrom(receiver)
+            assert data == 'hello'
+        finally:
+            for sock in socks:
+                sock.close()
+
+    def test_tos_sender(self, pair):
+        sender, receiver = pair
+        linux.TosSender().sendto(sender, 'hello', receiver.getsockname(),
+                                 0xb8)
+        assert receiver.recvfrom(512) == ('hello', sender.getsockname())
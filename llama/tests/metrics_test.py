@@ -1,115 +1,139 @@
 """Unittests for metrics lib."""
 
 from llama import metrics
+import json
 import pytest
 import time
 
 
 @pytest.fixture
-def two_things():
-    class Thing(object):
-        dp1 = metrics.Datapoint('dp1')
-        dp2 = metrics.Datapoint('dp2')
-    return Thing(), Thing()
+def table():
+    table = metrics.MetricsTable()
+    table.add('10.0.0.1', src='a', dst='b')
+    table.add('10.0.0.2', src='a', dst='c')
+    return table
 
 
-class TestDatapoint(object):
-    """Let's test the Datapoint descriptor."""
+class TestMetricsTable(object):
 
-    def test_setget_single(self, two_things, monkeypatch):
-        obj1, obj2 = two_things
-        monkeypatch.setattr(time, 'time', lambda: 100)
-        obj1.dp1 = 1241
-        assert obj1.dp1 == ('dp1', 1241, 100)
-
-    def test_setget_multidatapoint(self, two_things, monkeypatch):
-        obj1, obj2 = two_things
-        monkeypatch.setattr(time, 'time', lambda: 999)
-        obj1.dp1 = 1241
-        obj1.dp2 = 0.1111
-        assert obj1.dp1 == ('dp1', 1241, 999)
-        assert obj1.dp2 == ('dp2', 0.1111, 999)
-
-    def test_setget_multiclass(self, two_things, monkeypatch):
-        obj1, obj2 = two_things
-        monkeypatch.setattr(time, 'time', lambda: 12345)
-        obj1.dp1 = 1241
-        obj1.dp2 = 0.1111
-        obj2.dp1 = 3000
-        obj2.dp2 = 1234567890123456
-        assert obj1.dp2 == ('dp2', 0.1111, 12345)
-        assert obj2.dp1 == ('dp1', 3000, 12345)
-        assert obj2.dp2 == ('dp2', 1234567890123456, 12345)
-        # another round
-        obj1.dp1 = 0
-        obj1.dp2 = 10.1111
-        assert obj1.dp1 == ('dp1', 0, 12345)
-        assert obj1.dp2 == ('dp2', 10.1111, 12345)
-
-
-@pytest.fixture
-def m1():
-    m = metrics.Metrics(src='host2',
-                        metro='iad', facility='iad2', cluster='iad2a')
-    return m
-
-
-class TestMetrics(object):
+    def test_add(self, table):
+        assert table.add('10.0.0.1') == 0
+        assert len(table) == 2
+        assert '10.0.0.2' in table
+        assert table.keys() == ['10.0.0.1', '10.0.0.2']
+        assert table['10.0.0.2'].tags == {'src': 'a', 'dst': 'c'}
 
-    def test_constructor(self, m1):
-        assert m1
+    def test_update(self, table, monkeypatch):
+        monkeypatch.setattr(time, 'time', lambda: 100)
+        table.update('10.0.0.1', rtt=1.5, loss='0')
+        assert table.get('10.0.0.1', 'rtt') == ('rtt', 1.5, 100)
+        assert table.get('10.0.0.1', 'loss') == ('loss', 0.0, 100)
+        assert table.get('10.0.0.2', 'rtt') == ('rtt', None, None)
+        table.update('10.0.0.1', rtt=None)
+        assert table.get('10.0.0.1', 'rtt') == ('rtt', None, 100)
+        with pytest.raises(metrics.DatapointError):
+            table.update('10.0.0.1', bogus=1)
+
+    def test_row(self, table, monkeypatch):
+        monkeypatch.setattr(time, 'time', lambda: 100)
+        row = table['10.0.0.1']
+        row.rtt = 70
+        row.stale = True
+        assert row.rtt == ('rtt', 70.0, 100)
+        assert row.stale
+        assert table.is_stale('10.0.0.1')
+        with pytest.raises(KeyError):
+            table['10.0.0.3']
+
+    def test_as_influx(self, table, monkeypatch):
+        monkeypatch.setattr(time, 'time', lambda: 100)
+        table.update('10.0.0.1', rtt=70, loss=1.2)
+        assert ('rtt', 70.0, 100) in table.as_dict('10.0.0.1')['data']
+        points = table.as_influx
+        assert len(points) == 12
+        assert {'measurement': 'loss', 'tags': {'src': 'a', 'dst': 'b'},
+                'fields': {'value': 1.2}, 'time': 100000000000} in points
+        assert {'measurement': 'rtt', 'tags': {'src': 'a', 'dst': 'c'},
+                'fields': {'value': None}, 'time': None} in points
+        assert len(table.as_dicts) == 2
+
+    def test_history(self, monkeypatch):
+        now = [100]
+        monkeypatch.setattr(time, 'time', lambda: now[0])
+        table = metrics.MetricsTable(history=3)
+        table.add('10.0.0.1', dst='b')
+        table.add('10.0.0.2', dst='c')
+        size = len(table.history_times)
+        assert size == 6
+        for rtt in range(1, 6):
+            now[0] += 1
+            table.update('10.0.0.1', rtt=rtt)
+            table.snapshot('10.0.0.1')
+        # Only the last 3 snapshots are kept, without growing the buffers
+        assert len(table.history_times) == size
+        history = table.history_of(0)
+        assert history['time'] == [103, 104, 105]
+        assert history['rtt'] == [3.0, 4.0, 5.0]
+        assert history['loss'] == [None, None, None]
+        assert table.history_of(0, since=104)['rtt'] == [5.0]
+        assert table.history_of(1)['time'] == []
+        assert table.as_history(since=200) == [
+            {'tags': {'dst': 'b'}, 'history': table.history_of(0, 200)},
+            {'tags': {'dst': 'c'}, 'history': table.history_of(1, 200)}]
+
+    def test_history_disabled(self, table):
+        table.snapshot('10.0.0.1')
+        assert table.history_of(0)['time'] == []
+
+    def test_as_influx_line(self, monkeypatch):
+        monkeypatch.setattr(time, 'time', lambda: 100)
+        table = metrics.MetricsTable()
+        table.add('10.0.0.1', src='a', dst=u'b c,d=e')
+        table.add('10.0.0.2', src='a', dst='f')
+        table.update('10.0.0.1', rtt=70, loss=1.2)
+        assert table.tagsets[0].line == ',dst=b\\ c\\,d\\=e,src=a'
+        assert table.as_influx_line == (
+            'rtt,dst=b\\ c\\,d\\=e,src=a value=70.0 100000000000\n'
+            'loss,dst=b\\ c\\,d\\=e,src=a value=1.2 100000000000\n')
+
+    def test_as_influx_line_empty_tags(self):
+        table = metrics.MetricsTable()
+        table.add('10.0.0.1', src='a', dst='', cluster=None)
+        assert table.tagsets[0].line == ',src=a'
+
+    def test_tagsets_interned(self, table):
+        table.add('10.0.0.3', src='a', dst='b')
+        assert table.tagsets[2] is table.tagsets[0]
+        assert table.tags[2] is table.tags[0]
+        assert table.tagsets[1] is not table.tagsets[0]
+        assert table.tagsets[0].series['rtt'] == 'rtt,dst=b,src=a'
+
+    def test_as_json(self, table, monkeypatch):
+        monkeypatch.setattr(time, 'time', lambda: 100)
+        table.update('10.0.0.1', rtt=70, loss=1.2)
+        table.set_stale('10.0.0.2')
 
-    def test_tags(self, m1):
-        assert m1.tags == {
-            'src': 'host2',
-            'metro': 'iad',
-            'facility': 'iad2',
-            'cluster': 'iad2a'
-        }
+        def lists(data):
+            return json.loads(json.dumps(data))
 
-    def test_data(self, m1):
-        assert len(m1.data) == 2
+        assert json.loads(table.as_json) == lists(table.as_dicts)
+        assert json.loads(table.as_influx_json) == lists(table.as_influx)
 
-    def test_as_dict(self, m1, monkeypatch):
-        monkeypatch.setattr(time, 'time', lambda: 100)
-        m1.rtt = 1
-        m1.loss = 2
-        assert m1.as_dict['tags'] == {
-            'src': 'host2',
-            'metro': 'iad',
-            'facility': 'iad2',
-            'cluster': 'iad2a'
-        }
-        assert ('rtt', 1, 100) in m1.as_dict['data']
-        assert ('loss', 2, 100) in m1.as_dict['data']
-
-    def test_as_influx(self, monkeypatch):
+    def test_remove(self, monkeypatch):
         monkeypatch.setattr(time, 'time', lambda: 100)
-        m1 = metrics.Metrics(src='a', dst='b')
-        m1.rtt = 70
-        m1.loss = 1.2
-        point1 = {
-            'measurement': 'rtt',
-            'tags': {
-                'src': 'a',
-                'dst': 'b',
-            },
-            'time': 100000000000,
-            'fields': {
-                'value': 70
-            }
-        }
-        point2 = {
-            'measurement': 'loss',
-            'tags': {
-                'src': 'a',
-                'dst': 'b',
-            },
-            'time': 100000000000,
-            'fields': {
-                'value': 1.2
-            }
-        }
-        assert type(m1.as_influx) is list
-        assert point1 in m1.as_influx
-        assert point2 in m1.as_influx
+        table = metrics.MetricsTable(history=2)
+        for x in range(3):
+            table.add('10.0.0.%s' % x, dst=str(x))
+            table.update('10.0.0.%s' % x, rtt=x)
+            table.snapshot('10.0.0.%s' % x)
+        table.remove('10.0.0.0')
+        assert table.keys() == ['10.0.0.2', '10.0.0.1']
+        assert table.index == {'10.0.0.2': 0, '10.0.0.1': 1}
+        assert table['10.0.0.2'].rtt.value == 2.0
+        assert table['10.0.0.2'].tags == {'dst': '2'}
+        assert table.history_of(0)['rtt'] == [2.0]
+        assert len(table.history_times) == 4
+        table.remove('10.0.0.1')
+        table.remove('10.0.0.2')
+        assert len(table) == 0
+        assert len(table.values['rtt']) == 0
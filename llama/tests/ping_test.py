@@ -1,6 +1,8 @@
 """Unittests for metrics lib."""
 
 from llama import ping
+from llama import resolver
+from llama import udp
 from llama import util
 import pytest
 
@@ -31,3 +33,46 @@ class TestHping3(object):
     def test_good(self, monkeypatch):
         monkeypatch.setattr(util, 'runcmd', fake_runcmd)
         assert ping.hping3('somehost', count=5) == ('0', '0.1', 'somehost')
+
+
+class TestSendUdp(object):
+
+    def test_senders_reused(self, monkeypatch):
+        monkeypatch.setattr(udp.SequencedSender, 'run', lambda self: None)
+        senders = {}
+        ping.send_udp('127.0.0.1', 5, sequenced=True, senders=senders)
+        sender, _ = senders['127.0.0.1']
+        ping.send_udp('127.0.0.1', 5, sequenced=True, senders=senders)
+        assert senders['127.0.0.1'][0] is sender
+        # Changing how the target is probed replaces the sender
+        ping.send_udp('127.0.0.1', 10, sequenced=True, senders=senders)
+        assert senders['127.0.0.1'][0] is not sender
+
+    def test_nothing_sent(self, monkeypatch):
+        monkeypatch.setattr(udp.Sender, 'run', lambda self: None)
+        result = ping.send_udp('127.0.0.1', 5)
+        # Not 0% loss
+        assert result.loss is None
+        assert result.error
+
+    def test_unsequenced_not_kept(self, monkeypatch):
+        # Sender binds a socket per probe, too many to keep for every target
+        monkeypatch.setattr(udp.Sender, 'run', lambda self: None)
+        monkeypatch.setattr(udp.Sender, 'stats', udp.UdpStats(
+            5, 0, 0.0, 1.0, 1.0, 1.0))
+        closed = []
+        monkeypatch.setattr(udp.Sender, 'close',
+                            lambda self: closed.append(self))
+        senders = {}
+        ping.send_udp('127.0.0.1', 5, senders=senders)
+        assert senders == {}
+        assert len(closed) == 1
+
+    def test_unresolvable(self, monkeypatch):
+        def resolve(host):
+            raise resolver.Error('Failed to resolve "%s"' % host)
+        monkeypatch.setattr(resolver, 'resolve', resolve)
+        result = ping.send_udp('nowhere', 5, sequenced=True)
+        assert result.loss is None
+        assert result.stats is None
+        assert 'nowhere' in result.error
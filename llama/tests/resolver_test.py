@@ -0,0 +1,38 @@
+"""Unittests for resolver lib."""
+
+from llama import linux
+from llama import resolver
+import pytest
+import socket
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    calls = []
+
+    def getaddrinfo(host, *args):
+        calls.append(host)
+        if host == 'nowhere':
+            raise socket.gaierror(-2, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_DGRAM, 17, '',
+                 ('10.0.0.%s' % len(calls), 0))]
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    return calls
+
+
+class TestResolver(object):
+
+    def test_cached_until_ttl(self, lookups, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr(linux, 'monotonic', lambda: now[0])
+        cache = resolver.Resolver(ttl=10)
+        assert cache.resolve('somehost') == '10.0.0.1'
+        assert cache.resolve('somehost') == '10.0.0.1'
+        assert lookups == ['somehost']
+        now[0] += 10
+        assert cache.resolve('somehost') == '10.0.0.2'
+
+    def test_failure(self, lookups):
+        with pytest.raises(resolver.Error):
+            resolver.Resolver().resolve('nowhere')
@@ -0,0 +1,53 @@
+"""Unittests for scraper lib."""
+
+import importlib
+import pytest
+import sys
+import types
+
+
+class FakeInfluxDBClient(object):
+
+    writes = []
+
+    def __init__(self, host, port, database=None):
+        self.database = database
+
+    def write(self, data, params=None, expected_response_code=204,
+              protocol='json'):
+        self.writes.append((data, params, protocol))
+
+
+@pytest.fixture
+def scraper(monkeypatch):
+    # influxdb may not be installed, and is never contacted
+    influxdb = types.ModuleType('influxdb')
+    influxdb.InfluxDBClient = FakeInfluxDBClient
+    monkeypatch.setitem(sys.modules, 'influxdb', influxdb)
+    monkeypatch.delitem(sys.modules, 'llama.scraper', raising=False)
+    monkeypatch.setattr(FakeInfluxDBClient, 'writes', [])
+    return importlib.import_module('llama.scraper')
+
+
+class TestCollectorClient(object):
+
+    def test_run_line_protocol(self, scraper, monkeypatch):
+        lines = ('rtt,dst=b\\ c,src=\xc3\xa9 value=70.0 100000000000\n'
+                 'loss,dst=b\\ c,src=\xc3\xa9 value=1.2 100000000000\n')
+        monkeypatch.setattr(scraper, 'http_get',
+                            lambda *args, **kwargs: (200, lines))
+        client = scraper.CollectorClient('collector', 5000,
+                                         line_protocol=True)
+        client.run('influx', 8086, 'llama')
+        (data, params, protocol), = FakeInfluxDBClient.writes
+        assert protocol == 'line'
+        assert params == {'db': 'llama'}
+        assert ('\n'.join(data) + '\n').encode('utf-8') == lines
+
+    def test_run_line_protocol_error(self, scraper, monkeypatch):
+        monkeypatch.setattr(scraper, 'http_get',
+                            lambda *args, **kwargs: (500, ''))
+        client = scraper.CollectorClient('collector', 5000,
+                                         line_protocol=True)
+        client.run('influx', 8086, 'llama')
+        assert FakeInfluxDBClient.writes == []
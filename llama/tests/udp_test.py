@@ -1,7 +1,59 @@
 """Unittests for udp lib"""
 
+from llama import linux
 from llama.udp import UdpData, UdpStats, Sender, Ipv4UdpSocket
+from llama.udp import MultiReflector, Prober, Reflector, ReflectorPool
+from llama.udp import FlowStats, SequencedSender
+import multiprocessing
+import os
 import pytest
+import signal
+import socket
+import struct
+import threading
+import time
+
+
+@pytest.fixture
+def reflector_port():
+    reflector = Reflector(0)
+    thread = threading.Thread(target=reflector.run)
+    thread.daemon = True
+    thread.start()
+    return reflector.sock.getsockname()[1]
+
+
+@pytest.fixture
+def high_fds():
+    """Opens enough descriptors that new ones are numbered over 1024."""
+    socks = []
+    while not socks or socks[-1].fileno() < 1100:
+        socks.append(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+    yield
+    for sock in socks:
+        sock.close()
+
+
+@pytest.fixture
+def legacy_reflector_port():
+    """A reflector which, like the earliest ones, only accepts FORMAT."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+
+    def reflect():
+        while True:
+            data, addr = sock.recvfrom(512)
+            try:
+                struct.unpack(Ipv4UdpSocket.FORMAT, data)
+            except struct.error:
+                continue
+            sock.sendto(data, addr)
+
+    thread = threading.Thread(target=reflect)
+    thread.daemon = True
+    thread.start()
+    return sock.getsockname()[1]
+
 
 class TestSender(object):
 
@@ -32,19 +84,390 @@ class TestSender(object):
                 False, # Lost
             ),
         ]
-        # TODO: This should be updated to reflect the commented/correct
-        #       values once #27 has been resolved.
-        mock_stats = UdpStats(
+        sender = Sender('127.0.0.1', 60000, 3, tos=0x00, timeout=0.2)
+        for result in mock_results:
+            sender.record(result)
+        stats = sender.stats
+        assert stats[:6] == (
             3, # sent
             1, # lost
             33.33333333333333, # loss
             14.978885650634766, # rtt_max
-            # 12.727022171020508, # rtt_min
-            0, # rtt_min - This is due to #27
-            # 13.852953910827637, # rtt_avg
-            9.235302607218424, # rtt_avg - This is due to #27
+            12.727022171020508, # rtt_min
+            13.852953910827637, # rtt_avg
         )
-        sender = Sender('127.0.0.1', 60000, 3, tos=0x00, timeout=0.2)
-        sender.results = mock_results
+        # Percentiles are approximate, but within the observed range
+        assert 12.727022171020508 <= stats.rtt_p50 <= 14.978885650634766
+        assert stats.rtt_p50 == pytest.approx(12.727022171020508, rel=0.02)
+        assert stats.rtt_p999 == pytest.approx(14.978885650634766, rel=0.02)
+        assert stats.dwell_avg is None
+
+    def test_stats_all_lost(self):
+        sender = Sender('127.0.0.1', 60000, 1, tos=0x00, timeout=0.2)
+        sender.record(UdpData(Ipv4UdpSocket.SIGNATURE, 0x00, 0, 0, 0, True))
         stats = sender.stats
-        assert stats == mock_stats
+        assert stats.loss == 100.0
+        assert stats.rtt_avg is None
+        assert stats.rtt_p99 is None
+
+    def test_high_fds(self, high_fds, reflector_port):
+        sender = Sender('127.0.0.1', reflector_port, 20, timeout=0.2)
+        sender.run()
+        sender.close()
+        assert sender.stats.sent == 20
+        assert sender.stats.lost == 0
+
+    def test_sockets_reused_across_runs(self, reflector_port):
+        sender = Sender('127.0.0.1', reflector_port, 5, timeout=0.2)
+        ports = [x.getsockname()[1] for x in sender.batches[0]]
+        sender.run()
+        sender.run()
+        assert [x.getsockname()[1] for x in sender.batches[0]] == ports
+        assert sender.stats.sent == 5
+        assert sender.stats.lost == 0
+        sender.close()
+
+
+class TestFlowStats(object):
+
+    def test_stats(self):
+        flow = FlowStats()
+        flow.add(UdpData(Ipv4UdpSocket.SIGNATURE, 0x00, 1.0, 3.0, 2.0, False))
+        flow.add(UdpData(Ipv4UdpSocket.SIGNATURE, 0x00, 0, 0, 0, True))
+        flow.add(UdpData(Ipv4UdpSocket.SIGNATURE, 0x00, 1.0, 5.0, 4.0, False))
+        assert flow.stats == UdpStats(3, 1, 1 / 3.0 * 100, 4.0, 2.0, 3.0)
+
+    def test_all_lost(self):
+        flow = FlowStats()
+        flow.add(UdpData(Ipv4UdpSocket.SIGNATURE, 0x00, 0, 0, 0, True))
+        assert flow.stats.loss == 100.0
+        assert flow.stats.rtt_avg is None
+
+
+class TestSequencedSender(object):
+
+    def test_run(self, reflector_port):
+        sender = SequencedSender('127.0.0.1', reflector_port, 20,
+                                 timeout=0.2, window=5)
+        sender.run()
+        stats = sender.stats
+        assert stats.sent == 20
+        assert stats.lost == 0
+        assert stats.rtt_min > 0
+        assert stats.dwell_avg >= 0
+
+    def test_legacy_reflector(self, legacy_reflector_port):
+        sender = SequencedSender('127.0.0.1', legacy_reflector_port, 10,
+                                 timeout=0.2)
+        sender.run()
+        assert sender.stats.lost == 0
+        # Nothing stamped the probes
+        assert sender.stats.dwell_avg is None
+
+    def test_timestamps(self, reflector_port):
+        sender = SequencedSender('127.0.0.1', reflector_port, 20,
+                                 timeout=0.2, timestamps=True)
+        sender.run()
+        assert sender.stats.lost == 0
+        assert 0 < sender.stats.rtt_min <= sender.stats.rtt_max < 200
+
+    def test_rate(self, reflector_port):
+        sender = SequencedSender('127.0.0.1', reflector_port, 11,
+                                 timeout=0.2, rate=100)
+        start = time.time()
+        sender.run()
+        # The first probe goes out immediately, the other 10 are paced.
+        assert time.time() - start >= 0.09
+        assert sender.stats.lost == 0
+
+    def test_reused_across_runs(self, reflector_port):
+        sender = SequencedSender('127.0.0.1', reflector_port, 10, timeout=0.2)
+        sender.run()
+        sender.run()
+        assert sender.stats.sent == 10
+        assert sender.stats.lost == 0
+
+    def test_lost(self):
+        # This socket never reflects anything, so every probe is lost.
+        sock = Ipv4UdpSocket()
+        sock.bind(('127.0.0.1', 0))
+        sender = SequencedSender('127.0.0.1', sock.getsockname()[1], 3,
+                                 timeout=0.05)
+        sender.run()
+        assert sender.stats.lost == 3
+
+
+class TestIpv4UdpSocket(object):
+
+    def test_drain(self):
+        receiver = Ipv4UdpSocket(timeout=0.2)
+        receiver.bind(('127.0.0.1', 0))
+        sender = Ipv4UdpSocket()
+        sender.tos_sendto('127.0.0.1', receiver.getsockname()[1])
+        sender.tos_sendto('127.0.0.1', receiver.getsockname()[1])
+        time.sleep(0.01)
+        start = time.time()
+        assert receiver.drain() == 2
+        assert receiver.drain() == 0
+        # Never waits for the socket timeout
+        assert time.time() - start < 0.1
+
+    def test_seq_recvfrom_ignores_legacy(self):
+        receiver = Ipv4UdpSocket(timeout=0.2)
+        receiver.bind(('127.0.0.1', 0))
+        sock = Ipv4UdpSocket()
+        sock.tos_sendto('127.0.0.1', receiver.getsockname()[1])
+        assert receiver.seq_recvfrom() == (None, None)
+
+    def test_seq_roundtrip(self):
+        receiver = Ipv4UdpSocket(timeout=0.2)
+        receiver.bind(('127.0.0.1', 0))
+        sock = Ipv4UdpSocket(tos=0x20)
+        sock.seq_sendto('127.0.0.1', receiver.getsockname()[1], 1234)
+        seq, result = receiver.seq_recvfrom()
+        assert seq == 1234
+        assert result.tos == 0x20
+        assert not result.lost
+        assert (struct.calcsize(Ipv4UdpSocket.SEQ_FORMAT) ==
+                struct.calcsize(Ipv4UdpSocket.FORMAT))
+        # Nothing stamped the probe on its way
+        assert result.dwell is None
+
+    def test_seq_recvfrom_v1(self):
+        receiver = Ipv4UdpSocket(timeout=0.2)
+        receiver.bind(('127.0.0.1', 0))
+        sock = Ipv4UdpSocket()
+        sock.sendto(struct.pack(Ipv4UdpSocket.SEQ_FORMAT,
+                                Ipv4UdpSocket.SIGNATURE, 0, time.time() * 1000,
+                                77, 0, 0, 1),
+                    receiver.getsockname())
+        seq, result = receiver.seq_recvfrom()
+        assert seq == 77
+        assert not result.lost
+        assert result.dwell is None
+
+    def test_reflector_stamps(self, reflector_port):
+        sock = Ipv4UdpSocket(timeout=0.2)
+        sock.seq_sendto('127.0.0.1', reflector_port, 5)
+        seq, result = sock.seq_recvfrom()
+        assert seq == 5
+        assert result.dwell >= 0
+        assert result.fwd is not None
+        assert result.rev is not None
+        assert result.rtt >= 0
+
+
+class TestProber(object):
+
+    def test_run(self, reflector_port):
+        prober = Prober(window=8)
+        stats = prober.run(['127.0.0.1', '127.0.0.2'], 10, reflector_port,
+                           tos=(0x00, 0x20), timeout=0.2)
+        assert sorted(stats.keys()) == [
+            ('127.0.0.1', 0x00), ('127.0.0.1', 0x20),
+            ('127.0.0.2', 0x00), ('127.0.0.2', 0x20)]
+        for result in stats.values():
+            assert result.sent == 10
+            assert result.lost == 0
+        # Sockets are kept for the next run
+        assert len(prober.socks) == 2
+
+    def test_rate(self, reflector_port):
+        start = time.time()
+        stats = Prober().run(['127.0.0.1', '127.0.0.2'], 6, reflector_port,
+                             timeout=0.2, rate=100)
+        # Probes are paced at 100 per second per target: 200 in total.
+        assert time.time() - start >= 0.05
+        for result in stats.values():
+            assert result.lost == 0
+
+    def test_timestamps(self, reflector_port):
+        stats = Prober(timestamps=True).run(['127.0.0.1'], 10, reflector_port)
+        result = stats[('127.0.0.1', 0x00)]
+        assert result.lost == 0
+        assert 0 < result.rtt_min <= result.rtt_max < 200
+
+    def test_src_ports(self, reflector_port):
+        ports = []
+        for x in range(3):
+            sock = Ipv4UdpSocket()
+            sock.bind(('', 0))
+            ports.append(sock.getsockname()[1])
+            sock.close()
+        prober = Prober(src_ports=ports)
+        stats = prober.run(['127.0.0.1', '127.0.0.2'], 6, reflector_port,
+                           timeout=0.2)
+        assert stats[('127.0.0.1', 0x00)].sent == 6
+        assert len(prober.socks) == 3
+        assert sorted(prober.flow_stats.keys()) == sorted(
+            (target, 0x00, port) for target in ('127.0.0.1', '127.0.0.2')
+            for port in ports)
+        for flow in prober.flow_stats.values():
+            assert flow.sent == 2
+            assert flow.lost == 0
+            assert 0 < flow.rtt_min <= flow.rtt_avg <= flow.rtt_max
+
+    def test_src_ports_tos(self, reflector_port):
+        ports = []
+        for x in range(2):
+            sock = Ipv4UdpSocket()
+            sock.bind(('', 0))
+            ports.append(sock.getsockname()[1])
+            sock.close()
+        prober = Prober(src_ports=ports)
+        stats = prober.run(['127.0.0.1'], 4, reflector_port,
+                           tos=(0x00, 0x20), timeout=0.2)
+        assert len(prober.socks) == 2
+        for tos in (0x00, 0x20):
+            assert stats[('127.0.0.1', tos)].sent == 4
+            assert stats[('127.0.0.1', tos)].lost == 0
+            for port in ports:
+                assert prober.flow_stats[('127.0.0.1', tos, port)].sent == 2
+
+    def test_lost(self):
+        sock = Ipv4UdpSocket()
+        sock.bind(('127.0.0.1', 0))
+        stats = Prober().run(['127.0.0.1'], 3, sock.getsockname()[1],
+                             timeout=0.05)
+        assert stats[('127.0.0.1', 0x00)].lost == 3
+
+    def test_deadline(self):
+        sock = Ipv4UdpSocket()
+        sock.bind(('127.0.0.1', 0))
+        start = time.time()
+        stats = Prober().run(['127.0.0.1'], 3, sock.getsockname()[1],
+                             timeout=1.0, deadline=start + 0.05)
+        assert time.time() - start < 0.5
+        # Incomplete results are left out
+        assert stats == {}
+
+
+class TestMultiReflector(object):
+
+    def test_run(self):
+        reflector = MultiReflector([0, 0])
+        thread = threading.Thread(target=reflector.run)
+        thread.daemon = True
+        thread.start()
+        for sock in reflector.socks:
+            sender = SequencedSender('127.0.0.1', sock.getsockname()[1], 5,
+                                     timeout=0.2)
+            sender.run()
+            assert sender.stats.lost == 0
+        # Counters are bumped just after each reply is sent
+        deadline = time.time() + 1
+        while reflector.processed < 10 and time.time() < deadline:
+            time.sleep(0.01)
+        assert reflector.processed == 10
+
+
+class TestReflector(object):
+
+    @pytest.mark.skipif(not linux.MMSG_AVAILABLE,
+                        reason='recvmmsg()/sendmmsg() are not available')
+    def test_batch(self):
+        reflector = Reflector(0, batch=16)
+        assert reflector.batch
+        thread = threading.Thread(target=reflector.run)
+        thread.daemon = True
+        thread.start()
+        sender = SequencedSender('127.0.0.1', reflector.sock.getsockname()[1],
+                                 50, tos=0x20, timeout=0.2, window=16)
+        sender.run()
+        assert sender.stats.lost == 0
+        assert sender.stats.dwell_avg >= 0
+
+    @pytest.mark.parametrize('batch', [0, 16])
+    def test_mixed_tos(self, batch):
+        reflector = Reflector(0, batch=batch)
+        thread = threading.Thread(target=reflector.run)
+        thread.daemon = True
+        thread.start()
+        stats = Prober().run(['127.0.0.1'], 10,
+                             reflector.sock.getsockname()[1],
+                             tos=(0x00, 0x20, 0xb8), timeout=0.2)
+        assert sum(x.lost for x in stats.values()) == 0
+        if linux.SENDMSG_AVAILABLE:
+            # TOS went out as ancillary data; the socket's own is untouched
+            assert reflector.sock.tos_cmsg
+            assert reflector.sock._tos == 0x00
+
+    def test_report(self, monkeypatch):
+        reflector = Reflector(0, report_interval=10)
+        monkeypatch.setattr(time, 'time', lambda: reflector._report_time + 5)
+        reflector.sock.processed = 100
+        reflector.report()
+        assert reflector.pps == 0.0
+        monkeypatch.setattr(time, 'time', lambda: reflector._report_time + 10)
+        reflector.report()
+        assert reflector.pps == 10.0
+
+
+def _supervise(port, pids):
+    pool = ReflectorPool(port, 2)
+    pool.check()
+    pids.put([proc.pid for proc in pool.procs])
+    pool.run()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    # Reparented zombies count as gone
+    with open('/proc/%s/stat' % pid) as stat:
+        return stat.read().split(')')[-1].split()[0] != 'Z'
+
+
+class TestReflectorPool(object):
+
+    @pytest.mark.parametrize('signum', [signal.SIGTERM, signal.SIGKILL])
+    def test_supervisor_killed(self, signum):
+        if signum == signal.SIGKILL and not linux.SENDMSG_AVAILABLE:
+            pytest.skip('prctl() not available')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        pids = multiprocessing.Queue()
+        supervisor = multiprocessing.Process(target=_supervise,
+                                             args=(port, pids))
+        supervisor.start()
+        workers = pids.get(timeout=5)
+        try:
+            os.kill(supervisor.pid, signum)
+            supervisor.join(5)
+            deadline = time.time() + 5
+            while any(_alive(x) for x in workers) and time.time() < deadline:
+                time.sleep(0.05)
+            assert not any(_alive(x) for x in workers)
+        finally:
+            for pid in workers:
+                if _alive(pid):
+                    os.kill(pid, signal.SIGKILL)
+
+    def test_restart(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        pool = ReflectorPool(port, 2)
+        try:
+            pool.check()
+            sender = SequencedSender('127.0.0.1', port, 10, timeout=0.2)
+            # Workers may still be starting up
+            deadline = time.time() + 5
+            while pool.processed < 10 and time.time() < deadline:
+                sender.run()
+                time.sleep(0.05)
+            processed = pool.processed
+            assert processed >= 10
+            os.kill(pool.procs[0].pid, signal.SIGKILL)
+            pool.procs[0].join()
+            pool.check()
+            assert pool.restarts == 1
+            assert pool.procs[0].is_alive()
+            assert pool.processed >= processed
+        finally:
+            pool.stop()
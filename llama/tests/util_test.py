@@ -1,5 +1,6 @@
 """Unittests for util lib."""
 
+from llama import linux
 from llama import util
 import pytest  # noqa
 
@@ -32,3 +33,43 @@ class TestUtil(object):
         assert results.returncode == 2
         assert results.stderr
         assert not results.stdout
+
+    def test_parse_ports(self):
+        """Test ``util.parse_ports()``"""
+        assert util.parse_ports('5000') == [5000]
+        assert util.parse_ports('5000-5002,6000') == [5000, 5001, 5002, 6000]
+
+
+class TestTokenBucket(object):
+
+    @pytest.fixture
+    def clock(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr(linux, 'monotonic', lambda: now[0])
+        return now
+
+    def test_refill(self, clock):
+        bucket = util.TokenBucket(10, burst=2)
+        assert util.try_acquire([bucket]) == 0
+        assert util.try_acquire([bucket]) == 0
+        assert util.try_acquire([bucket]) == pytest.approx(0.1)
+        clock[0] += 0.05
+        assert util.try_acquire([bucket]) == pytest.approx(0.05)
+        clock[0] += 0.051
+        assert util.try_acquire([bucket]) == 0
+        # Never refills beyond the burst size
+        clock[0] += 10
+        assert bucket.delay() == 0
+        bucket.take()
+        bucket.take()
+        assert bucket.delay() == pytest.approx(0.1)
+
+    def test_try_acquire_all_or_nothing(self, clock):
+        slow = util.TokenBucket(1)
+        fast = util.TokenBucket(100)
+        assert util.try_acquire([slow, fast, None]) == 0
+        assert util.try_acquire([slow, fast]) == pytest.approx(1.0)
+        # The fast bucket kept its token as the slow one had none
+        clock[0] += 0.01
+        assert fast.delay() == 0
+        assert util.try_acquire([None]) == 0
@@ -14,8 +14,16 @@ solve this we encode TOS bits into the payload of the datagrams.
 
 The Sender class sends large quantities of UDP probes in batches.
 
+The SequencedSender class sends all probes for a target over one socket and
+matches replies back to probes by a sequence number carried in the payload.
+
+The Prober class drives sequenced probes for many targets and TOS classes from
+a single thread using non-blocking sockets and epoll.
+
 The Reflector class runs a simple loop: receive, decode TOS, set timestamp,
-encode TOS, send back.
+encode TOS, send back. The MultiReflector class runs the same loop for several
+ports from one thread. The ReflectorPool class runs several Reflector processes
+on one port to use more than one core.
 
 TOS is encoded as 8-bits (1-byte, 2-hex digits). See
 https://www.tucny.com/Home/dscp-tos for a reference.
@@ -23,11 +31,22 @@ https://www.tucny.com/Home/dscp-tos for a reference.
 
 import collections
 import concurrent.futures
+import errno
+import heapq
+import itertools
 import logging
+import multiprocessing
+import os
+import select
+import signal
 import socket
 import struct
+import threading
 import time
 
+from llama import histogram
+from llama import linux
+from llama import resolver
 from llama import util
 
 
@@ -42,7 +61,13 @@ UdpData = collections.namedtuple(
                 'sent',         # Time datagram was placed on wire in ms
                 'rcvd',         # Time datagram was returned to sender in ms
                 'rtt',          # Total round-trip time in ms
-                'lost'])        # Boolean, was our packet returned to sender?
+                'lost',         # Boolean, was our packet returned to sender?
+                'dwell',        # Time spent within the reflector in ms
+                'fwd',          # One-way delay, sender to reflector in ms
+                'rev'])         # One-way delay, reflector to sender in ms
+# Only reflectors which stamp probes (see Ipv4UdpSocket.SEQ_FORMAT) provide
+# dwell and one-way delays; they are None otherwise.
+UdpData.__new__.__defaults__ = (None, None, None)
 
 
 # UDP statistics returned at the end of each probe cycle.
@@ -52,7 +77,133 @@ UdpStats = collections.namedtuple(
                  'loss',        # Loss, expressed as a percentage
                  'rtt_max',     # Maximum round trip time
                  'rtt_min',     # Minimum round trip time
-                 'rtt_avg'])    # Average (mean) round trip time
+                 'rtt_avg',     # Average (mean) round trip time
+                 'dwell_avg',   # Average time spent within the reflector
+                 'fwd_avg',     # Average one-way delay to the reflector
+                 'rev_avg',     # Average one-way delay from the reflector
+                 'rtt_p50',     # Median round trip time
+                 'rtt_p90',     # 90th percentile round trip time
+                 'rtt_p99',     # 99th percentile round trip time
+                 'rtt_p999'])   # 99.9th percentile round trip time
+# RTT statistics only include returned probes, so they are None when every
+# probe was lost.
+UdpStats.__new__.__defaults__ = (None,) * 7
+
+
+class ProbeStats(object):
+    """Streaming aggregation of probe results into UdpStats.
+
+    RTTs of returned probes are recorded in a fixed-size Histogram, so memory
+    stays constant no matter how many probes are sent, and lost probes no
+    longer pull RTT statistics towards zero.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.lost = 0
+        self.rtt = histogram.Histogram()
+        self.stamped = 0
+        self._dwell = 0.0
+        self._fwd = 0.0
+        self._rev = 0.0
+
+    def add(self, result):
+        """Record a single probe result.
+
+        Args:
+            result: (UdpData) of the probe
+        """
+        self.sent += 1
+        if result.lost:
+            self.lost += 1
+            return
+        self.rtt.add(result.rtt)
+        if result.dwell is not None:
+            self.stamped += 1
+            self._dwell += result.dwell
+            self._fwd += result.fwd
+            self._rev += result.rev
+
+    @property
+    def stats(self):
+        """Returns a namedtuple containing UDP loss/latency results."""
+        if self.sent == 0:
+            logging.critical('Sender has zero results, likely as a '
+                             'result of exceptions during probing')
+            return UdpStats(0, 0, 0.0, 0.0, 0.0, 0.0)
+        loss = (float(self.lost) / float(self.sent)) * 100
+        dwell = fwd = rev = None
+        if self.stamped:
+            dwell = self._dwell / self.stamped
+            fwd = self._fwd / self.stamped
+            rev = self._rev / self.stamped
+        return UdpStats(self.sent, self.lost, loss, self.rtt.max,
+                        self.rtt.min, self.rtt.mean, dwell, fwd, rev,
+                        self.rtt.percentile(50), self.rtt.percentile(90),
+                        self.rtt.percentile(99), self.rtt.percentile(99.9))
+
+
+class FlowStats(object):
+    """Cheap aggregation of probe results for a single flow.
+
+    Only counts and RTT extremes are kept, without a histogram, so loss can
+    be attributed to individual flows across thousands of targets.
+    """
+
+    __slots__ = ['sent', 'lost', 'rtt_total', 'rtt_min', 'rtt_max']
+
+    def __init__(self):
+        self.sent = 0
+        self.lost = 0
+        self.rtt_total = 0.0
+        self.rtt_min = None
+        self.rtt_max = None
+
+    def add(self, result):
+        """Record a single probe result.
+
+        Args:
+            result: (UdpData) of the probe
+        """
+        self.sent += 1
+        if result.lost:
+            self.lost += 1
+            return
+        self.rtt_total += result.rtt
+        if self.rtt_min is None or result.rtt < self.rtt_min:
+            self.rtt_min = result.rtt
+        if self.rtt_max is None or result.rtt > self.rtt_max:
+            self.rtt_max = result.rtt
+
+    @property
+    def stats(self):
+        """Returns UdpStats without dwell times or percentiles."""
+        if self.sent == 0:
+            return UdpStats(0, 0, 0.0, 0.0, 0.0, 0.0)
+        loss = (float(self.lost) / float(self.sent)) * 100
+        rtt_avg = None
+        if self.sent > self.lost:
+            rtt_avg = self.rtt_total / (self.sent - self.lost)
+        return UdpStats(self.sent, self.lost, loss, self.rtt_max,
+                        self.rtt_min, rtt_avg)
+
+
+def monotonic_rtt(sent, rcvd):
+    """Returns round trip time from a monotonic send time.
+
+    The receive time, often a kernel timestamp, is moved onto the monotonic
+    clock by its age, so wall clock steps between send and receive don't skew
+    the result.
+
+    Args:
+        sent: (float) send time in seconds from linux.monotonic()
+        rcvd: (float) receive time in ms since the epoch
+
+    Returns:
+        (float) round trip time in ms
+    """
+    age = time.time() * 1000 - rcvd
+    return (linux.monotonic() - sent) * 1000 - age
 
 
 class Ipv4UdpSocket(socket.socket):
@@ -66,13 +217,30 @@ class Ipv4UdpSocket(socket.socket):
 
     SIGNATURE = '__llama__'     # Identify LLAMA packets from other UDP
     FORMAT = '<10sBddd?'        # Used to pack/unpack struct data
+    # Sequenced probes are the same size as FORMAT, so every reflector
+    # echoes them, but reuse the rcvd and rtt bytes which senders leave at
+    # zero, and carry a version in place of the lost flag:
+    #   (signature, tos, sent ms, sequence number, reflector dwell ms,
+    #    reflector rcvd ms, version)
+    # Reflectors which know version 2 stamp their receive time and dwell;
+    # others echo the probe as-is, leaving them at zero. Version 1 probes
+    # are never stamped.
+    SEQ_FORMAT = '<10sBdIfdB'
+    SEQ_VERSIONS = (1, 2)
+    SEQ_VERSION = 2
+    HEADER_SIZE = struct.calcsize(FORMAT)
+    TOS_OFFSET = struct.calcsize('<10s')
+    STAMP_OFFSET = struct.calcsize('<10sBdI')
+    VERSION_OFFSET = HEADER_SIZE - 1
 
-    def __init__(self, tos=0x00, timeout=util.DEFAULT_TIMEOUT):
+    def __init__(self, tos=0x00, timeout=util.DEFAULT_TIMEOUT,
+                 timestamps=False):
         """Constructor.
 
         Args:
             tos:  (hex) TOS bits expressed as 2-bytes
             timeout: (float) Number of seconds to block/wait socket operation
+            timestamps: (bool) Use kernel receive timestamps where available
         """
         super(Ipv4UdpSocket, self).__init__(socket.AF_INET, socket.SOCK_DGRAM,
                                             socket.IPPROTO_UDP)
@@ -80,6 +248,42 @@ class Ipv4UdpSocket(socket.socket):
         self.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, self._tos)
         self.settimeout(timeout)
         self.processed = 0
+        # Replies set TOS per datagram with ancillary data where possible
+        self.tos_cmsg = linux.SENDMSG_AVAILABLE
+        self._tos_sender = None
+        self._receiver = None
+        if timestamps:
+            self.enable_timestamps()
+
+    def enable_timestamps(self):
+        """Timestamp received datagrams in the kernel (SO_TIMESTAMPNS).
+
+        Returns:
+            (bool) True if kernel timestamps are in use
+        """
+        if not linux.RECVMSG_AVAILABLE:
+            logging.warn('Kernel receive timestamps are not available; '
+                         'timestamping received datagrams in Python')
+            return False
+        self.setsockopt(socket.SOL_SOCKET, linux.SO_TIMESTAMPNS, 1)
+        self._receiver = linux.TimestampReceiver()
+        return True
+
+    def timed_recvfrom(self, bufsize=512):
+        """Like recvfrom(), also returning when the datagram was received.
+
+        Args:
+            bufsize: (int) number of bytes to read from socket
+
+        Returns:
+            (tuple) of (data, address, receive time in ms since the epoch);
+            the receive time comes from the kernel if timestamps are enabled
+        """
+        if self._receiver is None:
+            data, addr = self.recvfrom(bufsize)
+            return data, addr, time.time() * 1000
+        data, addr, rcvd = self._receiver.recvfrom(self)
+        return data, addr, rcvd * 1000
 
     def tos_sendto(self, ip, port):
         """Mimic the behavior of socket.sendto() with special behavior.
@@ -97,6 +301,61 @@ class Ipv4UdpSocket(socket.socket):
                                        time.time() * 1000, 0, 0, False),
                            (ip, port))
 
+    def seq_sendto(self, ip, port, seq, tos=None):
+        """Like tos_sendto(), but carries a sequence number in the payload.
+
+        Args:
+            ip: (str) destination IP address
+            port: (int) destination UDP port
+            seq: (int) 32-bit sequence number identifying this probe
+            tos: (int) TOS byte for this probe only, sent as with
+                 tos_reply(); None uses the socket's TOS
+
+        Returns:
+            (int) the number of bytes sent on the socket
+        """
+        data = struct.pack(self.SEQ_FORMAT, self.SIGNATURE,
+                           self._tos if tos is None else tos,
+                           time.time() * 1000, seq, 0, 0, self.SEQ_VERSION)
+        if tos is None:
+            return self.sendto(data, (ip, port))
+        return self.tos_reply(data, (ip, port), tos)
+
+    def seq_recvfrom(self, bufsize=512):
+        """Receive a reflected probe sent with seq_sendto().
+
+        Args:
+            bufsize: (int) number of bytes to read from socket
+                     It's not advisable to change this.
+
+        Any sequenced version is accepted. When the reflector stamped the
+        probe, reflector dwell time is excluded from RTT and one-way delays
+        are filled in; these assume the sender's and reflector's clocks are
+        in sync.
+
+        Returns:
+            (tuple) of (sequence number, UdpData); both are None if the
+            datagram was not a sequenced LLAMA probe
+
+        Raises:
+            socket.timeout: if nothing arrived before the socket timeout
+        """
+        data, addr, rcvd = self.timed_recvfrom(bufsize)
+        if (len(data) != self.HEADER_SIZE or
+                ord(data[self.VERSION_OFFSET]) not in self.SEQ_VERSIONS):
+            return None, None
+        (signature, tos, sent, seq, dwell, reflector_rcvd,
+         _) = struct.unpack(self.SEQ_FORMAT, data)
+        if signature.rstrip('\x00') != self.SIGNATURE:
+            return None, None
+        results = UdpData(signature, tos, sent, rcvd, rcvd - sent, False)
+        if reflector_rcvd:
+            results = results._replace(
+                rtt=results.rtt - dwell, dwell=dwell,
+                fwd=reflector_rcvd - sent,
+                rev=rcvd - reflector_rcvd - dwell)
+        return seq, results
+
     def tos_recvfrom(self, bufsize=512):
         """Mimic the behavior of socket.recvfrom() with special behavior.
 
@@ -108,9 +367,8 @@ class Ipv4UdpSocket(socket.socket):
             (UdpData) namedtuple containing timestamps
         """
         try:
-            data, addr = self.recvfrom(bufsize)
-            rcvd = time.time() * 1000
-            results = UdpData._make(struct.unpack(self.FORMAT, data))
+            data, addr, rcvd = self.timed_recvfrom(bufsize)
+            results = UdpData(*struct.unpack(self.FORMAT, data))
             rtt = rcvd - results.sent
             return results._replace(rcvd=rcvd, rtt=rtt, lost=False)
         except socket.timeout:
@@ -118,6 +376,69 @@ class Ipv4UdpSocket(socket.socket):
                 self.gettimeout()))
             return UdpData(self.SIGNATURE, self._tos, 0, 0, 0, True)
 
+    def drain(self, bufsize=512):
+        """Discard datagrams already waiting on the socket.
+
+        Returns:
+            (int) number of datagrams discarded
+        """
+        discarded = 0
+        # A plain recv() would wait out the socket timeout once empty
+        timeout = self.gettimeout()
+        self.setblocking(False)
+        try:
+            while True:
+                try:
+                    self.recv(bufsize)
+                except socket.error as exc:
+                    if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return discarded
+                    raise
+                discarded += 1
+        finally:
+            self.settimeout(timeout)
+
+    def set_tos(self, tos):
+        """Set TOS on the socket itself, skipping the call if unchanged."""
+        if tos != self._tos:
+            self.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, tos)
+            self._tos = tos
+
+    def tos_reply(self, data, addr, tos):
+        """Send a datagram with its own TOS using a single system call.
+
+        TOS is sent as IP_TOS ancillary data when the platform supports it.
+        Otherwise the socket's TOS is changed, but only when it differs from
+        the previous datagram's.
+
+        Args:
+            data: (str) datagram payload
+            addr: (tuple) of (IPv4 address, port)
+            tos: (int) TOS byte for this datagram
+
+        Returns:
+            (int) the number of bytes sent on the socket
+        """
+        if self.tos_cmsg:
+            if self._tos_sender is None:
+                self._tos_sender = linux.TosSender()
+            try:
+                return self._tos_sender.sendto(self, data, addr, tos)
+            except socket.error as exc:
+                if exc.errno != errno.EINVAL:
+                    raise
+                logging.warn('IP_TOS ancillary data was rejected; falling '
+                             'back to setsockopt() for TOS')
+                self.tos_cmsg = False
+        self.set_tos(tos)
+        return self.sendto(data, addr)
+
+    @classmethod
+    def stampable(cls, data):
+        """Returns True if a probe has room for reflector timestamps."""
+        return (len(data) == cls.HEADER_SIZE and
+                data[cls.VERSION_OFFSET] == chr(2))
+
     def tos_reflect(self, bufsize=512):
         """Intended to be the sole operation on a LLAMA reflector.
 
@@ -125,26 +446,40 @@ class Ipv4UdpSocket(socket.socket):
             bufsize: (int) number of bytes to read from socket
                      It's not advisable to change this.
         """
-        data, addr = self.recvfrom(bufsize)
+        data, addr, rcvd = self.timed_recvfrom(bufsize)
         try:
-            udpdata = UdpData._make(struct.unpack(self.FORMAT, data))
+            udpdata = UdpData(*struct.unpack_from(self.FORMAT, data))
         except struct.error:
             logging.warn('Received malformed datagram of %s bytes. '
                          'Discarding.', len(data))
             # Don't reflect invalid data
             return
-        self.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, udpdata.tos)
-        self.sendto(data, addr)
+        if self.stampable(data):
+            data = (data[:self.STAMP_OFFSET] +
+                    struct.pack('<fd', time.time() * 1000 - rcvd, rcvd) +
+                    data[self.VERSION_OFFSET:])
+        self.tos_reply(data, addr, udpdata.tos)
         self.processed += 1
         if self.processed % 512 == 0:
             logging.info('Processed packets: %s', self.processed)
 
 
+def _limiters(rate, pacer):
+    """Returns the token buckets limiting a sender.
+
+    Args:
+        rate: (float) maximum probes per second for this sender, or None
+        pacer: (util.TokenBucket) shared bucket, or None
+    """
+    return [pacer, util.TokenBucket(rate) if rate else None]
+
+
 class Sender(object):
     """UDP Sender class capable of sending/receiving UDP probes."""
 
     def __init__(self, target, port, count, tos=0x00,
-                 timeout=util.DEFAULT_TIMEOUT):
+                 timeout=util.DEFAULT_TIMEOUT, timestamps=False, rate=None,
+                 pacer=None):
         """Constructor.
 
         Args:
@@ -153,15 +488,48 @@ class Sender(object):
             count: (int) number of UDP datagram probes to send
             tos: (hex) TOS bits
             timeout: (float) in seconds
+            timestamps: (bool) use kernel receive timestamps
+            rate: (float) maximum probes per second to this target
+            pacer: (util.TokenBucket) shared with other senders to limit
+                   the total probe rate
         """
         self.target = target
         self.port = port
+        self.count = count
+        self.tos = tos
+        self.timeout = timeout
+        self.timestamps = timestamps
+        self.limiters = _limiters(rate, pacer)
+        self.probe_stats = ProbeStats()
+        self._lock = threading.Lock()
+        self._ran = False
+        self._bind()
+
+    def _bind(self):
+        """Create and bind the probe sockets."""
         sockets = []
-        for x in range(0, count):
-            sock = Ipv4UdpSocket(tos=tos, timeout=timeout)
+        for x in range(0, self.count):
+            sock = Ipv4UdpSocket(tos=self.tos, timeout=self.timeout,
+                                 timestamps=self.timestamps)
             sock.bind(('', 0))
             sockets.append(sock)
-        self.batches = util.array_split(sockets, 50)
+        self.batches = list(util.array_split(sockets, 50))
+
+    def close(self):
+        """Close the probe sockets."""
+        for batch in self.batches:
+            for sock in batch:
+                sock.close()
+
+    def record(self, result):
+        """Record the result of a single probe.
+
+        Args:
+            result: (UdpData) of the probe
+        """
+        logging.debug(result)
+        with self._lock:
+            self.probe_stats.add(result)
 
     def send_and_recv(self, batch):
         """Send and receive a single datagram and store results.
@@ -170,12 +538,26 @@ class Sender(object):
             batch: (list of socket objects) for sending/receiving
         """
         for sock in batch:
-            sock.tos_sendto(self.target, self.port)
-            self.results.append(sock.tos_recvfrom())
+            util.acquire(self.limiters)
+            sock.tos_sendto(self.address, self.port)
+            self.record(sock.tos_recvfrom())
 
     def run(self):
-        """Run the sender."""
-        self.results = []
+        """Run the sender.
+
+        Raises:
+            resolver.Error: if the target can't be resolved
+        """
+        self.probe_stats = ProbeStats()
+        self.address = resolver.resolve(self.target)
+        if self._ran:
+            # Replies which arrived after a previous run timed out
+            discarded = sum(sock.drain() for batch in self.batches
+                            for sock in batch)
+            if discarded:
+                logging.debug('Discarded %s late replies from %s',
+                              discarded, self.target)
+        self._ran = True
         exception_jobs = []
         jobs = []
         with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
@@ -186,8 +568,6 @@ class Sender(object):
                 # So just handle logging any exceptions.
                 if job.exception():
                     exception_jobs.append(job)
-        for result in self.results:
-            logging.debug(result)
         if len(exception_jobs) > 0:
             logging.critical("Encountered {} exceptions while running Sender. "
                              "Logging one such exception as an "
@@ -196,39 +576,688 @@ class Sender(object):
                 exception_jobs[0].result()
             except Exception as e:
                 logging.exception(e)
+            # Sockets are otherwise kept between runs, so the same flows are
+            # probed each time; start over with fresh ones after errors.
+            self.close()
+            self._bind()
 
     @property
     def stats(self):
         """Returns a namedtuple containing UDP loss/latency results."""
-        sent = len(self.results)
-        if sent is 0:
-            logging.critical('Sender has zero results, likely as a '
-                             'result of exceptions during probing')
-            # TODO: Better handling for this requires a greater refactor
-            return UdpStats(0, 0, 0.0, 0.0, 0.0, 0.0)
-        lost = sum(x.lost for x in self.results)
-        loss = (float(lost) / float(sent)) * 100
-        # TODO: This includes 0 values for instances of loss
-        #       Handling this requires more work around null
-        #       values along the various components and DB
-        rtt_values = [x.rtt for x in self.results]
-        rtt_min = min(rtt_values)
-        rtt_max = max(rtt_values)
-        rtt_avg = util.mean(rtt_values)
-        return UdpStats(sent, lost, loss, rtt_max, rtt_min, rtt_avg)
+        return self.probe_stats.stats
+
+
+class SequencedSender(Sender):
+    """UDP Sender which sends every probe over one long-lived socket.
+
+    Each probe carries a sequence number and replies are matched back to
+    their probe by that number, so a single socket (and source port) can keep
+    up to ``window`` probes in flight at once. Results are recorded the same
+    way as Sender, so ``stats`` behaves identically.
+
+    With ``timestamps``, replies are timestamped by the kernel and send times
+    are kept on a monotonic clock, so RTT doesn't grow with how busy the
+    sending process is.
+    """
+
+    def __init__(self, target, port, count, tos=0x00,
+                 timeout=util.DEFAULT_TIMEOUT, window=50, timestamps=False,
+                 rate=None, pacer=None):
+        """Constructor.
+
+        Args:
+            target: (str) IP address or hostname of destination
+            port: (int) UDP port of destination
+            count: (int) number of UDP datagram probes to send
+            tos: (hex) TOS bits
+            timeout: (float) in seconds
+            window: (int) maximum number of probes in flight at once
+            timestamps: (bool) use kernel receive timestamps and monotonic
+                        send times for RTT
+            rate: (float) maximum probes per second to this target
+            pacer: (util.TokenBucket) shared with other senders to limit
+                   the total probe rate
+        """
+        self.target = target
+        self.port = port
+        self.count = count
+        self.limiters = _limiters(rate, pacer)
+        self.tos = tos
+        self.timeout = timeout
+        self.window = window
+        self.timestamps = timestamps
+        self.probe_stats = ProbeStats()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._bind()
+
+    def _bind(self):
+        """Create and bind the probe socket."""
+        self.sock = Ipv4UdpSocket(tos=self.tos, timeout=self.timeout,
+                                  timestamps=self.timestamps)
+        self.sock.bind(('', 0))
+
+    def close(self):
+        """Close the probe socket."""
+        self.sock.close()
+
+    def _next_seq(self):
+        """Returns the next sequence number, wrapping at 32-bits.
+
+        Sequence numbers keep counting across runs so late replies from a
+        previous run can never be mistaken for current probes.
+        """
+        seq = self._seq
+        self._seq = (self._seq + 1) & 0xffffffff
+        return seq
+
+    def _lost(self):
+        return UdpData(Ipv4UdpSocket.SIGNATURE, self.tos, 0, 0, 0, True)
+
+    def send_and_recv(self):
+        """Send all probes, keeping up to ``window`` in flight at once."""
+        inflight = {}  # seq -> monotonic send time
+        deadlines = collections.deque()  # (deadline, seq) in send order
+        sent = 0
+        while sent < self.count or inflight:
+            pace = 0
+            while sent < self.count and len(inflight) < self.window:
+                # Never sleep for tokens here, replies would sit unread and
+                # inflate RTT; wait for them on the socket instead.
+                pace = util.try_acquire(self.limiters)
+                if pace:
+                    break
+                seq = self._next_seq()
+                inflight[seq] = linux.monotonic()
+                self.sock.seq_sendto(self.address, self.port, seq)
+                deadlines.append((time.time() + self.timeout, seq))
+                sent += 1
+            # Expire probes which have outlived the timeout. Every probe uses
+            # the same timeout, so deadlines are already in order.
+            now = time.time()
+            while deadlines and (deadlines[0][1] not in inflight or
+                                 deadlines[0][0] <= now):
+                deadline, seq = deadlines.popleft()
+                if inflight.pop(seq, None) is not None:
+                    self.record(self._lost())
+            if not inflight:
+                if pace:
+                    time.sleep(pace)
+                continue
+            wait = deadlines[0][0] - now
+            if pace:
+                wait = min(wait, pace)
+            self.sock.settimeout(max(wait, 0.001))
+            try:
+                seq, result = self.sock.seq_recvfrom()
+            except socket.timeout:
+                continue
+            if seq in inflight:
+                sent_time = inflight.pop(seq)
+                if self.timestamps:
+                    result = result._replace(
+                        rtt=monotonic_rtt(sent_time, result.rcvd) -
+                        (result.dwell or 0))
+                self.record(result)
+            elif seq is not None:
+                logging.debug('Discarding late or duplicate probe seq=%s',
+                              seq)
+
+    def run(self):
+        """Run the sender.
+
+        Raises:
+            resolver.Error: if the target can't be resolved
+        """
+        self.probe_stats = ProbeStats()
+        self.address = resolver.resolve(self.target)
+        try:
+            self.send_and_recv()
+        except socket.error as exc:
+            logging.critical('Encountered an exception while running '
+                             'SequencedSender against %s after %s results',
+                             self.target, self.probe_stats.sent)
+            logging.exception(exc)
+            self.close()
+            self._bind()
+
+
+class Poller(object):
+    """Waits for any of a set of sockets to become readable.
+
+    Uses epoll where available (Linux), otherwise falls back to select().
+    """
+
+    def __init__(self):
+        self.socks = {}
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+
+    def register(self, sock):
+        """Watch a socket for readability."""
+        self.socks[sock.fileno()] = sock
+        if self._epoll:
+            self._epoll.register(sock.fileno(), select.EPOLLIN)
+
+    def wait(self, timeout=None):
+        """Wait for sockets to become readable.
+
+        Args:
+            timeout: (float) seconds to wait, or None to wait forever
+
+        Returns:
+            list of readable sockets
+        """
+        if self._epoll:
+            if timeout is None:
+                timeout = -1
+            return [self.socks[fd] for fd, _ in self._epoll.poll(timeout)]
+        readable, _, _ = select.select(self.socks.values(), [], [], timeout)
+        return readable
+
+
+class Prober(object):
+    """Event-loop prober which drives many targets from a single thread.
+
+    Probes for every target share one non-blocking socket per TOS class.
+    Replies are matched back to their target by sequence number and probes
+    which outlive the timeout are expired from a deadline heap. Sockets are
+    kept between runs, so a Prober is intended to be long-lived.
+
+    With ``src_ports``, every target is instead probed from the same fixed
+    set of source ports, rotating through them probe by probe. Each source
+    port is a distinct flow which ECMP may hash onto a different path, and
+    results for every flow are kept in ``flow_stats`` after each run, so
+    persistent loss on one path stands out even when a target's overall loss
+    is small. Each source port has one socket, shared by all targets and TOS
+    classes, with TOS set per probe, so this costs no more system calls than
+    probing without them.
+    """
+
+    def __init__(self, window=500, timestamps=False, src_ports=None):
+        """Constructor.
+
+        Args:
+            window: (int) maximum number of probes in flight at once
+            timestamps: (bool) use kernel receive timestamps and monotonic
+                        send times for RTT
+            src_ports: (list) of UDP source ports to sweep, each probing
+                       every TOS class, or None to use one ephemeral port
+                       per TOS class
+        """
+        self.window = window
+        self.timestamps = timestamps
+        self.src_ports = list(src_ports or [])
+        self.socks = {}
+        self.poller = Poller()
+        self.flow_stats = {}
+        self.resolve_errors = {}
+        self._seq = 0
+
+    def _get_sock(self, tos, src_port=None):
+        """Returns the (lazily created) socket for a TOS class or port.
+
+        A fixed source port can only be bound once, so its socket serves
+        every TOS class and probes sent on it must carry their own TOS.
+        """
+        key = tos if src_port is None else ('port', src_port)
+        sock = self.socks.get(key)
+        if sock is None:
+            sock = Ipv4UdpSocket(tos=tos, timeout=0.0,
+                                 timestamps=self.timestamps)
+            sock.bind(('', src_port or 0))
+            self.socks[key] = sock
+            self.poller.register(sock)
+        return sock
+
+    def _next_seq(self):
+        seq = self._seq
+        self._seq = (self._seq + 1) & 0xffffffff
+        return seq
+
+    def _drain(self, sock, inflight, results, flows):
+        """Read every pending datagram on a non-blocking socket."""
+        while True:
+            try:
+                seq, result = sock.seq_recvfrom()
+            except socket.error as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            probe = inflight.pop(seq, None)
+            if probe is not None:
+                key, sent, flow = probe
+                if self.timestamps:
+                    result = result._replace(
+                        rtt=monotonic_rtt(sent, result.rcvd) -
+                        (result.dwell or 0))
+                results[key].add(result)
+                if flow is not None:
+                    flows[flow].add(result)
+            elif seq is not None:
+                logging.debug('Discarding late or duplicate probe seq=%s',
+                              seq)
+
+    def run(self, targets, count, port=util.DEFAULT_DST_PORT, tos=(0x00,),
+            timeout=util.DEFAULT_TIMEOUT, rate=None, pacer=None,
+            deadline=None):
+        """Probe every target with every TOS class.
+
+        Probes are sent round-robin across targets so each target's probes
+        are spread across the run instead of sent back-to-back. That also
+        means a per-target ``rate`` can be enforced with one bucket for the
+        whole run, filled ``len(targets) * len(tos)`` times faster.
+
+        Args:
+            targets: (list) of IP addresses or hostnames
+            count: (int) number of probes per target and TOS class
+            port: (int) UDP port of destination reflectors
+            tos: (list) of TOS classes to probe with
+            timeout: (float) seconds to wait for each probe to return
+            rate: (float) maximum probes per second to each target and TOS
+            pacer: (util.TokenBucket) limits the total probe rate
+            deadline: (float) time.time() at which to stop sending probes
+                      and waiting for replies
+
+        Returns:
+            dict of {(target, tos): UdpStats}; with ``src_ports``, stats for
+            each flow are also left in ``flow_stats`` as
+            {(target, tos, src_port): UdpStats}. Targets which can't be
+            resolved aren't probed and are left out of the results; their
+            errors are left in ``resolve_errors`` as {target: message}.
+            Targets which didn't get every probe back or timed out before
+            the deadline are left out of the results too.
+        """
+        addresses = {}
+        self.resolve_errors = {}
+        for target in targets:
+            try:
+                addresses[target] = resolver.resolve(target)
+            except resolver.Error as exc:
+                self.resolve_errors[target] = str(exc)
+        targets = [x for x in targets if x in addresses]
+        keys = [(target, x) for target in targets for x in tos]
+        limiters = _limiters(rate and rate * len(keys), pacer)
+        results = dict((key, ProbeStats()) for key in keys)
+        flows = {}
+        rotations = {}
+        if self.src_ports:
+            flows = dict(((target, x, src_port), FlowStats())
+                         for target, x in keys for src_port in self.src_ports)
+            rotations = dict((key, itertools.cycle(self.src_ports))
+                             for key in keys)
+        pending = itertools.chain.from_iterable(itertools.repeat(keys, count))
+        # seq -> ((target, tos), monotonic send time, flow or None)
+        inflight = {}
+        deadlines = []  # heap of (deadline, seq)
+        retry = retry_port = None
+        exhausted = False
+        errors = 0
+        while True:
+            pace = 0
+            while len(inflight) < self.window:
+                pace = util.try_acquire(limiters)
+                if pace:
+                    break
+                key = retry or next(pending, None)
+                src_port = retry_port
+                retry = retry_port = None
+                if key is None:
+                    exhausted = True
+                    break
+                target, probe_tos = key
+                flow = None
+                if key in rotations:
+                    src_port = src_port or next(rotations[key])
+                    flow = (target, probe_tos, src_port)
+                seq = self._next_seq()
+                sent = linux.monotonic()
+                try:
+                    sock = self._get_sock(probe_tos, src_port)
+                    if src_port is None:
+                        sock.seq_sendto(addresses[target], port, seq)
+                    else:
+                        sock.seq_sendto(addresses[target], port, seq,
+                                        tos=probe_tos)
+                except socket.error as exc:
+                    if exc.errno in (errno.EAGAIN, errno.ENOBUFS):
+                        # Socket buffer is full; try again after polling.
+                        retry, retry_port = key, src_port
+                        break
+                    errors += 1
+                    logging.debug('Failed to send probe to %s: %s',
+                                  target, exc)
+                    continue
+                inflight[seq] = (key, sent, flow)
+                heapq.heappush(deadlines, (time.time() + timeout, seq))
+            now = time.time()
+            while deadlines and deadlines[0][0] <= now:
+                _, seq = heapq.heappop(deadlines)
+                probe = inflight.pop(seq, None)
+                if probe is not None:
+                    key, sent, flow = probe
+                    lost = UdpData(Ipv4UdpSocket.SIGNATURE, key[1], 0, 0, 0,
+                                   True)
+                    results[key].add(lost)
+                    if flow is not None:
+                        flows[flow].add(lost)
+            if exhausted and not inflight:
+                break
+            if deadline is not None and now >= deadline:
+                logging.warning('Deadline passed with %s probes in flight',
+                                len(inflight))
+                break
+            waits = [pace] if pace else []
+            if inflight:
+                waits.append(max(deadlines[0][0] - now, 0.0))
+            if retry is not None:
+                waits.append(0.001)
+            if deadline is not None:
+                waits.append(max(deadline - now, 0.0))
+            for sock in self.poller.wait(min(waits or [0.0])):
+                self._drain(sock, inflight, results, flows)
+        if errors:
+            logging.critical('Encountered %s exceptions while sending probes',
+                             errors)
+        if not exhausted or inflight:
+            # Only complete results are returned
+            results = dict((key, x) for key, x in results.iteritems()
+                           if x.sent == count)
+            flows = dict((flow, x) for flow, x in flows.iteritems()
+                         if flow[:2] in results)
+        self.flow_stats = dict((flow, x.stats)
+                               for flow, x in flows.iteritems())
+        return dict((key, x.stats) for key, x in results.iteritems())
 
 
 class Reflector(object):
-    """Simple Reflector class."""
+    """Simple Reflector class.
 
-    def __init__(self, port):
+    When ``batch`` is greater than one and recvmmsg()/sendmmsg() are
+    available (see llama.linux), up to ``batch`` datagrams are received and
+    reflected per system call. Otherwise one datagram is reflected at a time.
+    Either way, each reply carries its TOS as ancillary data where supported,
+    so mixed TOS classes don't cost extra setsockopt() calls.
+
+    Probes in the version 2 sequenced format are stamped with the times the
+    reflector received and sent them. With ``timestamps`` the receive time
+    comes from the kernel, so it includes time spent in the socket's queue;
+    batched reflection stamps the time each batch was read instead.
+    """
+
+    def __init__(self, port, batch=0, report_interval=60, reuse_port=False,
+                 counter=None, timestamps=False):
+        """Constructor.
+
+        Args:
+            port: (int) UDP port to bind
+            batch: (int) maximum datagrams to reflect per system call
+            report_interval: (float) seconds between packet rate reports
+            reuse_port: (bool) set SO_REUSEPORT so other reflectors may
+                        bind the same port
+            counter: (multiprocessing.Value) updated with processed packets
+                     so a parent process can read it
+            timestamps: (bool) stamp probes with kernel receive timestamps
+        """
         self.sock = Ipv4UdpSocket()
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, linux.SO_REUSEPORT, 1)
         self.sock.bind(('', port))
         sockname = self.sock.getsockname()
         logging.info('LLAMA reflector listening on %s udp/%s',
                      sockname[0], sockname[1])
         self.sock.setblocking(1)
+        self.batch = None
+        if batch > 1:
+            if linux.MMSG_AVAILABLE:
+                self.batch = linux.MessageBatch(batch)
+                logging.info('Reflecting up to %s datagrams per system call',
+                             batch)
+            else:
+                logging.warn('recvmmsg()/sendmmsg() are not available; '
+                             'reflecting one datagram per system call')
+        if timestamps and not self.batch:
+            self.sock.enable_timestamps()
+        self.counter = counter
+        self.report_interval = report_interval
+        self.pps = 0.0
+        self._report_time = time.time()
+        self._report_processed = 0
+
+    @property
+    def processed(self):
+        return self.sock.processed
+
+    def report(self):
+        """Log the packet rate once every ``report_interval`` seconds."""
+        now = time.time()
+        elapsed = now - self._report_time
+        if elapsed < self.report_interval:
+            return
+        self.pps = (self.processed - self._report_processed) / elapsed
+        self._report_time = now
+        self._report_processed = self.processed
+        logging.info('Processed packets: %s (%.1f pps)',
+                     self.processed, self.pps)
+
+    def reflect_batch(self):
+        """Receive and reflect a batch of datagrams."""
+        try:
+            count = self.batch.recv(self.sock)
+        except socket.error as exc:
+            if exc.errno == errno.EINTR:
+                return
+            raise
+        rcvd = time.time() * 1000
+        indexes = []
+        tos = []
+        stamped = []
+        for index in range(count):
+            length = self.batch.length(index)
+            buf = self.batch.bufs[index]
+            if length < Ipv4UdpSocket.HEADER_SIZE:
+                logging.warn('Received malformed datagram of %s bytes. '
+                             'Discarding.', length)
+                continue
+            indexes.append(index)
+            tos.append(ord(buf[Ipv4UdpSocket.TOS_OFFSET]))
+            if (length == Ipv4UdpSocket.HEADER_SIZE and
+                    buf[Ipv4UdpSocket.VERSION_OFFSET] == chr(2)):
+                stamped.append(index)
+        if not indexes:
+            return
+        if stamped:
+            sent = time.time() * 1000
+            for index in stamped:
+                struct.pack_into('<fd', self.batch.bufs[index],
+                                 Ipv4UdpSocket.STAMP_OFFSET, sent - rcvd,
+                                 rcvd)
+        if self.sock.tos_cmsg:
+            try:
+                self.sock.processed += self.batch.reply(self.sock, indexes,
+                                                        tos)
+                return
+            except socket.error as exc:
+                if exc.errno != errno.EINVAL:
+                    raise
+                logging.warn('IP_TOS ancillary data was rejected; falling '
+                             'back to setsockopt() for TOS')
+                self.sock.tos_cmsg = False
+        # Without per-datagram TOS, send one batch per TOS class
+        by_tos = {}
+        for index, value in zip(indexes, tos):
+            by_tos.setdefault(value, []).append(index)
+        for value, subset in by_tos.iteritems():
+            self.sock.set_tos(value)
+            self.sock.processed += self.batch.reply(self.sock, subset)
+
+    def run(self):
+        while True:
+            if self.batch:
+                self.reflect_batch()
+            else:
+                self.sock.tos_reflect()
+            if self.counter is not None:
+                self.counter.value = self.processed
+            self.report()
+
+
+def _run_reflector(port, batch, report_interval, counter, timestamps,
+                   parent):
+    """Entry point for ReflectorPool worker processes.
+
+    Workers exit when the supervisor (pid `parent`) does, however it dies, so
+    they never hold the port as orphans.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    linux.set_parent_death_signal(signal.SIGTERM)
+    if os.getppid() != parent:
+        # Supervisor died before the death signal was armed
+        return
+    reflector = Reflector(port, batch, report_interval, reuse_port=True,
+                          counter=counter, timestamps=timestamps)
+    reflector.run()
+
+
+class ReflectorPool(object):
+    """Supervises Reflector worker processes which share one port.
+
+    Every worker binds the same port with SO_REUSEPORT, so the kernel spreads
+    flows across workers (and therefore cores). Workers which die are
+    restarted and their processed packets are kept in the pool's total.
+    """
+
+    def __init__(self, port, workers, batch=0, report_interval=60,
+                 check_interval=1, timestamps=False):
+        """Constructor.
+
+        Args:
+            port: (int) UDP port for every worker to bind
+            workers: (int) number of worker processes
+            batch: (int) maximum datagrams to reflect per system call
+            report_interval: (float) seconds between packet rate reports
+            check_interval: (float) seconds between worker health checks
+            timestamps: (bool) stamp probes with kernel receive timestamps
+        """
+        self.port = port
+        self.timestamps = timestamps
+        self.batch = batch
+        self.report_interval = report_interval
+        self.check_interval = check_interval
+        self.counters = [multiprocessing.Value('L', 0, lock=False)
+                         for _ in range(workers)]
+        self.procs = [None] * workers
+        self.restarts = 0
+        self.pps = 0.0
+        self._retired = 0
+
+    @property
+    def processed(self):
+        """Total packets processed by current and past workers."""
+        return self._retired + sum(x.value for x in self.counters)
+
+    def start(self, index):
+        """Start (or restart) a single worker process."""
+        proc = multiprocessing.Process(
+            target=_run_reflector, name='llama-reflector-%s' % index,
+            args=(self.port, self.batch, self.report_interval,
+                  self.counters[index], self.timestamps, os.getpid()))
+        proc.daemon = True
+        proc.start()
+        self.procs[index] = proc
+        logging.info('Started reflector worker %s (pid %s)', index, proc.pid)
+
+    def check(self):
+        """Restart any workers which have died."""
+        for index, proc in enumerate(self.procs):
+            if proc is not None and proc.is_alive():
+                continue
+            if proc is not None:
+                logging.error('Reflector worker %s (pid %s) exited with %s; '
+                              'restarting', index, proc.pid, proc.exitcode)
+                self._retired += self.counters[index].value
+                self.counters[index].value = 0
+                self.restarts += 1
+            self.start(index)
+
+    def stop(self):
+        for proc in self.procs:
+            if proc is not None and proc.is_alive():
+                proc.terminate()
+        for proc in self.procs:
+            if proc is not None:
+                proc.join()
+
+    def run(self):
+        """Supervises workers until interrupted, then stops them.
+
+        SIGTERM raises SystemExit so workers are stopped rather than orphaned.
+        """
+        def terminate(signum, frame):
+            raise SystemExit(128 + signum)
+
+        signal.signal(signal.SIGTERM, terminate)
+        last_time = time.time()
+        last_processed = self.processed
+        try:
+            while True:
+                self.check()
+                time.sleep(self.check_interval)
+                now = time.time()
+                if now - last_time < self.report_interval:
+                    continue
+                processed = self.processed
+                self.pps = (processed - last_processed) / (now - last_time)
+                logging.info('Processed packets across %s workers: %s '
+                             '(%.1f pps, %s restarts)', len(self.procs),
+                             processed, self.pps, self.restarts)
+                last_time = now
+                last_processed = processed
+        finally:
+            self.stop()
+
+
+class MultiReflector(object):
+    """Reflector which serves several UDP ports from a single thread.
+
+    Sockets are non-blocking and multiplexed with a Poller, so each extra
+    port costs one file descriptor rather than a thread or process.
+    """
+
+    def __init__(self, ports):
+        """Constructor.
+
+        Args:
+            ports: (list) of UDP ports to bind
+        """
+        self.socks = []
+        self.poller = Poller()
+        for port in ports:
+            sock = Ipv4UdpSocket(timeout=0.0)
+            sock.bind(('', port))
+            sockname = sock.getsockname()
+            logging.info('LLAMA reflector listening on %s udp/%s',
+                         sockname[0], sockname[1])
+            self.socks.append(sock)
+            self.poller.register(sock)
+
+    @property
+    def processed(self):
+        return sum(x.processed for x in self.socks)
+
+    def reflect(self, sock):
+        """Reflect every pending datagram on a non-blocking socket."""
+        while True:
+            try:
+                sock.tos_reflect()
+            except socket.error as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
 
     def run(self):
         while True:
-            self.sock.tos_reflect()
+            for sock in self.poller.wait():
+                self.reflect(sock)
@@ -7,6 +7,10 @@ import collections
 import logging
 import shlex
 import subprocess
+import threading
+import time
+
+from llama import linux
 
 
 # Default port for targets
@@ -53,3 +57,94 @@ def runcmd(command):
             logging.debug(out.strip())
             stdout += out
     return CommandResults(runner.returncode, stdout, runner.stderr.read())
+
+
+def parse_ports(spec):
+    """Parse a list of ports like ``40000-40003,40100``.
+
+    Args:
+        spec: (str) comma separated ports or inclusive ranges of ports
+
+    Returns:
+        list of int ports, in the order given
+    """
+    ports = []
+    for item in spec.split(','):
+        if '-' in item:
+            low, high = item.split('-', 1)
+            ports.extend(range(int(low), int(high) + 1))
+        else:
+            ports.append(int(item))
+    return ports
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket for pacing probes.
+
+    Tokens refill at ``rate`` per second up to ``burst``. Taking a token may
+    leave the bucket in debt when it's shared between threads, in which case
+    later callers wait longer, so the long term rate is still honored.
+    """
+
+    def __init__(self, rate, burst=1):
+        """Constructor.
+
+        Args:
+            rate: (float) tokens added per second
+            burst: (float) maximum tokens held at once
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last = linux.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = linux.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self):
+        """Returns seconds until a token is available, 0 if one is now."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def take(self):
+        """Take a token, whether or not one is available."""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+
+
+def try_acquire(buckets):
+    """Take a token from every bucket, but only if all of them have one.
+
+    Args:
+        buckets: (list) of TokenBucket, None entries are ignored
+
+    Returns:
+        (float) 0 if tokens were taken, otherwise seconds to wait
+    """
+    buckets = [x for x in buckets if x is not None]
+    delay = max([x.delay() for x in buckets] or [0])
+    if not delay:
+        for bucket in buckets:
+            bucket.take()
+    return delay
+
+
+def acquire(buckets):
+    """Block until a token has been taken from every bucket.
+
+    Args:
+        buckets: (list) of TokenBucket, None entries are ignored
+    """
+    while True:
+        delay = try_acquire(buckets)
+        if not delay:
+            return
+        time.sleep(delay)